@@ -1,7 +1,8 @@
 """
 Remote IKernel entry point.
 
-From here you can get to 'manage', otherwise it is assumed
+From here you can get to 'manage' or the shared supervisor
+'daemon', otherwise it is assumed
 that a kernel is required instead and instance one instead.
 """
 
@@ -10,6 +11,13 @@ import sys
 if 'manage' in sys.argv:
     from remote_ikernel.manage import manage
     manage()
+elif 'daemon' in sys.argv[1:2]:
+    from remote_ikernel.daemon import start_daemon
+    start_daemon()
+elif '--daemon' in sys.argv:
+    # Thin client, leaves everything to the daemon
+    from remote_ikernel.daemon import start_client
+    start_client()
 else:
     from remote_ikernel.kernel import start_remote_kernel
     start_remote_kernel()
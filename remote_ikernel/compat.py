@@ -8,11 +8,12 @@ available.
 
 Provides the following modules:
     kernelspec -> {jupyter_client,IPython}.kernel.kernelspec
+    manager    -> {jupyter_client,IPython}.kernel.manager
     tempdir    -> {tempfile,IPython.utils.tempdir}
 
 """
 
-__all__ = ['kernelspec', 'tempdir']
+__all__ = ['kernelspec', 'manager', 'tempdir']
 
 # kernelspec is moved in jupyter
 try:
@@ -20,6 +21,12 @@ try:
 except ImportError:
     from IPython.kernel import kernelspec
 
+# as is the kernel manager
+try:
+    from jupyter_client import manager
+except ImportError:
+    from IPython.kernel import manager
+
 # This is a module copied from Python 3.2, so will exist
 # in 3.2 onwards
 import tempfile as tempdir
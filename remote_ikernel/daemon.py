@@ -0,0 +1,582 @@
+"""
+daemon.py
+
+Shared supervisor for remote kernels. A single daemon process hosts the
+launches, tunnels and health checks of every kernel started with
+``--daemon``, in one event loop. Each kernel process that the notebook
+starts becomes a thin client that registers with the daemon and waits
+until its kernel dies.
+
+Kernels that ask for packing share scheduler allocations, see
+``packing.py``.
+
+Run ``remote_ikernel daemon`` to start it in the foreground; clients will
+start it automatically if it is not running.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import errno
+import getpass
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# How often all the kernels get their health checks
+DEFAULT_INTERVAL = 5
+# How long a client waits for a freshly started daemon
+DAEMON_START_TIMEOUT = 10
+# Same look as the kernel logging, without needing tornado in the client
+_CLIENT_LOG_FMT = ("[%(levelname)1.1s %(asctime)s.%(msecs).03d %(name)s] "
+                   "%(message)s")
+
+
+def runtime_dir():
+    """
+    Private directory for the daemon socket and log, and for the ssh
+    control sockets of tunnels, in $XDG_RUNTIME_DIR if there is one,
+    otherwise in the temporary directory. It is created if needed and only
+    used if it belongs to the current user and nobody else can get into
+    it.
+
+    Returns
+    -------
+    path : str
+        Location of the directory.
+    """
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base and os.path.isdir(base):
+        path = os.path.join(base, 'remote_ikernel')
+    else:
+        path = os.path.join(tempfile.gettempdir(),
+                            'rik_{0}'.format(getpass.getuser()))
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+    # Anyone could have made it first in a shared directory
+    status = os.lstat(path)
+    if (not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or
+            status.st_mode & 0o077):
+        raise RuntimeError("{0} is not a private directory; refusing to "
+                           "use it.".format(path))
+    return path
+
+
+def default_socket_path():
+    """
+    Location of the daemon socket for the current user.
+    """
+    return os.path.join(runtime_dir(), 'daemon.sock')
+
+
+def _send(sock, message):
+    """Send a message as a single line of json."""
+    sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+class _LineReader(object):
+    """
+    Split the stream from a socket into json messages, one per line.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+
+    def read(self):
+        """
+        Read whatever is available and return the complete messages. An
+        EOFError is raised once the other end has closed the socket.
+        """
+        data = self.sock.recv(4096)
+        if not data:
+            raise EOFError
+        self.buffer += data
+        messages = []
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            if line.strip():
+                messages.append(json.loads(line.decode('utf-8')))
+        return messages
+
+
+class SupervisorDaemon(object):
+    """
+    Event loop that owns the RemoteIKernel instances for all the
+    connected clients.
+
+    """
+
+    def __init__(self, socket_path=None, interval=DEFAULT_INTERVAL):
+        self.socket_path = socket_path or default_socket_path()
+        self.interval = interval
+        self.log = logging.getLogger('remote_ikernel')
+        self.listener = None
+        self.clients = {}  # socket -> _LineReader
+        self.kernels = {}  # socket -> RemoteIKernel, once launched
+        self.launching = {}  # socket -> launch thread
+        self.finished = []  # (socket, kernel, error) from launch threads
+        self.stopping = []  # Threads shutting down kernels
+        self.allocations = []  # Shared jobs for packed kernels
+        self.packed = {}  # RemoteIKernel -> (Allocation, cpu ids)
+        self.lock = threading.Lock()
+
+    def bind(self):
+        """
+        Listen on the socket, clearing out any stale socket left by a
+        daemon that has died. Returns False if another daemon is
+        already listening.
+        """
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except socket.error:
+                os.remove(self.socket_path)
+            else:
+                return False
+            finally:
+                probe.close()
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the owner gets to start kernels through the daemon, and
+        # the socket must never be reachable by anyone else, even briefly
+        umask = os.umask(0o077)
+        try:
+            self.listener.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, 0o600)
+        self.listener.listen(128)
+        return True
+
+    def serve_forever(self):
+        """
+        Run the event loop. Client messages and kernel output are handled
+        as they arrive, all the kernels get a health check every interval.
+        """
+        self.log.info("Supervisor daemon listening on {0}.".format(
+            self.socket_path))
+        next_check = time.time() + self.interval
+        while True:
+            self.collect_launches()
+            kernel_fds = dict((kernel.connection.child_fd, kernel)
+                              for kernel in self.kernels.values()
+                              if kernel.connection is not None)
+            readers = [self.listener] + list(self.clients) + list(kernel_fds)
+            # Launch threads finish without waking us, so don't sleep
+            # through them for long.
+            wait = max(0, next_check - time.time())
+            if self.launching:
+                wait = min(wait, 1)
+            try:
+                readable = select.select(readers, [], [], wait)[0]
+            except select.error as error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for item in readable:
+                if item is self.listener:
+                    self.accept()
+                elif item in self.clients:
+                    self.handle_client(item)
+                elif item in kernel_fds:
+                    self.check_kernel(kernel_fds[item])
+
+            if time.time() >= next_check:
+                next_check = time.time() + self.interval
+                for kernel in list(self.kernels.values()):
+                    self.check_kernel(kernel)
+
+    def check_kernel(self, kernel):
+        """
+        Supervise a single kernel and let its client know if it died.
+        """
+        if not kernel.poll():
+            for client, client_kernel in list(self.kernels.items()):
+                if client_kernel is kernel:
+                    self.finish(client, {'event': 'died'})
+
+    def accept(self):
+        """Take on a new client."""
+        client = self.listener.accept()[0]
+        self.clients[client] = _LineReader(client)
+
+    def handle_client(self, client):
+        """
+        Act on messages from a client. A closed client means that the
+        notebook has finished with the kernel.
+        """
+        try:
+            messages = self.clients[client].read()
+        except (EOFError, socket.error):
+            self.disconnect(client)
+            return
+
+        for message in messages:
+            action = message.get('action')
+            if action == 'start':
+                self.start(client, message)
+            elif action == 'interrupt' and client in self.kernels:
+                self.kernels[client].log.info("Caught interrupt; sending to "
+                                              "kernel.")
+                self.kernels[client].interrupt()
+
+    def start(self, client, request):
+        """
+        Launch the kernel in a separate thread; waiting in a queue should
+        not hold up everything else.
+        """
+        thread = threading.Thread(target=self._launch,
+                                  args=(client, request))
+        thread.daemon = True
+        self.launching[client] = thread
+        thread.start()
+
+    def _launch(self, client, request):
+        """
+        Thread target that creates the kernel from the command line,
+        directory and environment of the client.
+        """
+        from remote_ikernel.kernel import (RemoteIKernel, _kernel_logger,
+                                           parse_kernel_args)
+        from remote_ikernel.packing import PACK_INTERFACES
+        kernel, error = None, None
+        allocation, cpu_ids = None, []
+        try:
+            args, kernel_args = parse_kernel_args(request['argv'],
+                                                  request['cwd'])
+            # Each kernel gets the environment that the notebook gave it
+            kernel_args['env'] = request['env']
+            # and its own logger, so the daemon log says which kernel it is
+            kernel_args['logger'] = _kernel_logger(
+                os.path.splitext(os.path.basename(
+                    kernel_args['connection_info']))[0],
+                kernel_args['verbose'])
+            pack_cpus = args.pack_cpus
+            if (pack_cpus and kernel_args['interface'] in PACK_INTERFACES and
+                    kernel_args['cpus'] <= pack_cpus):
+                allocation = self.reserve(kernel_args, pack_cpus)
+                kernel_args, cpu_ids = allocation.pack(kernel_args)
+            kernel = RemoteIKernel(**kernel_args)
+            # Never block the loop on a single kernel
+            if kernel.connection is not None:
+                kernel.connection.timeout = 0
+        except SystemExit:
+            # argparse has already described the problem in the log
+            error = ValueError("invalid kernel arguments")
+        except Exception as exc:  # pylint: disable=broad-except
+            error = exc
+        with self.lock:
+            if allocation is not None and kernel is not None:
+                self.packed[kernel] = (allocation, cpu_ids)
+            self.finished.append((client, kernel, error))
+        if allocation is not None and kernel is None:
+            self.release(allocation, cpu_ids)
+
+    def reserve(self, kernel_args, pack_cpus):
+        """
+        Find room for a kernel in an allocation that matches its launch
+        arguments, launching a new allocation if they are all full.
+
+        Parameters
+        ----------
+        kernel_args : dict
+            Keyword arguments for RemoteIKernel, as given by the client.
+        pack_cpus : int
+            Number of cpus to request for a new allocation.
+
+        Returns
+        -------
+        allocation : Allocation
+            A running allocation with cpus reserved for the kernel.
+        """
+        from remote_ikernel.packing import Allocation
+        cpus = kernel_args['cpus']
+        candidate = Allocation(kernel_args['interface'], pack_cpus,
+                               kernel_args['pe'], kernel_args['launch_args'],
+                               kernel_args['tunnel_hosts'],
+                               kernel_args['env'])
+        with self.lock:
+            for allocation in self.allocations:
+                # Allocations that are still launching are fine
+                finished = (allocation.ready.is_set() and
+                            not allocation.is_alive())
+                if (allocation.key == candidate.key and not finished and
+                        allocation.available >= cpus):
+                    break
+            else:
+                allocation = candidate
+                self.allocations.append(allocation)
+            allocation.reserved += cpus
+
+        if allocation is candidate:
+            allocation.start()
+        else:
+            allocation.ready.wait()
+
+        if allocation.error is not None:
+            with self.lock:
+                allocation.reserved -= cpus
+                if allocation in self.allocations:
+                    self.allocations.remove(allocation)
+            raise allocation.error
+
+        return allocation
+
+    def release(self, allocation, cpu_ids):
+        """
+        Return cpus to an allocation, ending the job when no kernels
+        are left in it.
+        """
+        allocation.unpack(cpu_ids)
+        with self.lock:
+            allocation.reserved -= len(cpu_ids)
+            empty = allocation.reserved <= 0
+            if empty and allocation in self.allocations:
+                self.allocations.remove(allocation)
+        if empty:
+            self.log.info("Releasing allocation on {0}.".format(
+                allocation.host))
+            allocation.shutdown()
+
+    def unpack(self, kernel):
+        """Release the allocation slot of a packed kernel, if it has one."""
+        with self.lock:
+            packed = self.packed.pop(kernel, None)
+        if packed is not None:
+            self.release(*packed)
+
+    def collect_launches(self):
+        """
+        Move kernels from finished launch threads into the event loop.
+        """
+        with self.lock:
+            finished, self.finished = self.finished, []
+        for client, kernel, error in finished:
+            self.launching.pop(client, None)
+            if client not in self.clients:
+                # Client went away while the kernel was starting
+                if kernel is not None:
+                    self.stop(kernel)
+            elif error is not None:
+                self.log.error("Kernel launch failed: {0}.".format(error))
+                self.finish(client, {'event': 'error',
+                                     'message': '{0}'.format(error)})
+            else:
+                self.kernels[client] = kernel
+                self.send(client, {'event': 'started', 'host': kernel.host})
+
+    def send(self, client, message):
+        """Send to a client that might have gone away."""
+        try:
+            _send(client, message)
+        except socket.error:
+            self.disconnect(client)
+
+    def finish(self, client, message):
+        """Tell a client that its kernel is done and drop it."""
+        self.send(client, message)
+        self.disconnect(client)
+
+    def shutdown(self):
+        """Shut down all the kernels and end any shared jobs."""
+        for client in list(self.clients):
+            self.disconnect(client)
+        for thread in self.stopping:
+            thread.join()
+        for allocation in self.allocations:
+            allocation.shutdown()
+        self.allocations = []
+
+    def disconnect(self, client):
+        """Forget a client and shut down its kernel."""
+        self.clients.pop(client, None)
+        kernel = self.kernels.pop(client, None)
+        if kernel is not None:
+            kernel.log.info("Shutting down kernel on {0}.".format(
+                kernel.host or 'this machine'))
+            self.stop(kernel)
+        client.close()
+
+    def stop(self, kernel):
+        """
+        Shut down a kernel in a separate thread; it might be writing back
+        staged files.
+        """
+        self.stopping = [thread for thread in self.stopping
+                         if thread.is_alive()]
+        thread = threading.Thread(target=self._stop, args=(kernel,))
+        thread.daemon = True
+        self.stopping.append(thread)
+        thread.start()
+
+    def _stop(self, kernel):
+        """Thread target that shuts down a kernel and frees its cpus."""
+        kernel.shutdown()
+        self.unpack(kernel)
+
+
+def _connect(socket_path):
+    """Return a socket connected to the daemon or None."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def _start_daemon(socket_path):
+    """
+    Start a detached daemon with its output going to a log file next to
+    the socket.
+    """
+    log_file = os.fdopen(os.open('{0}.log'.format(socket_path),
+                                 os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                 0o600), 'a')
+    subprocess.Popen([sys.executable, '-m', 'remote_ikernel', 'daemon',
+                      '--socket', socket_path],
+                     stdin=open(os.devnull), stdout=log_file,
+                     stderr=subprocess.STDOUT, close_fds=True,
+                     preexec_fn=os.setsid)
+
+
+def run_client(argv, socket_path=None):
+    """
+    Register a kernel with the daemon, starting the daemon if needed, and
+    stay alive until the kernel dies. SIGINT is passed on as an interrupt.
+
+    Parameters
+    ----------
+    argv : list of str
+        Command line arguments of the kernel launcher. The daemon
+        interprets them in the directory and environment of this process.
+    socket_path : str
+        Location of the daemon socket, defaults to one in a private
+        directory for the user, see runtime_dir.
+
+    Returns
+    -------
+    status : int
+        Exit status for the client process.
+    """
+    log = logging.getLogger('remote_ikernel')
+    socket_path = socket_path or default_socket_path()
+
+    sock = _connect(socket_path)
+    if sock is None:
+        _start_daemon(socket_path)
+        deadline = time.time() + DAEMON_START_TIMEOUT
+        while sock is None and time.time() < deadline:
+            time.sleep(0.1)
+            sock = _connect(socket_path)
+    if sock is None:
+        raise RuntimeError("Unable to reach the remote_ikernel daemon at "
+                           "{0}".format(socket_path))
+
+    def _interrupt(*_):
+        """Forward the notebook's interrupt."""
+        _send(sock, {'action': 'interrupt'})
+
+    signal.signal(signal.SIGINT, _interrupt)
+    _send(sock, {'action': 'start', 'argv': argv, 'cwd': os.getcwd(),
+                 'env': dict(os.environ)})
+
+    reader = _LineReader(sock)
+    while True:
+        try:
+            messages = reader.read()
+        except EOFError:
+            log.error("Lost connection to the daemon.")
+            return 1
+        except socket.error as error:
+            # Interrupted system call in Python 2
+            if error.args[0] == errno.EINTR:
+                continue
+            raise
+        for message in messages:
+            if message['event'] == 'started':
+                log.info("Kernel running on {0}.".format(
+                    message['host'] or 'this machine'))
+            elif message['event'] == 'error':
+                log.error("Kernel launch failed: {0}".format(
+                    message['message']))
+                return 1
+            elif message['event'] == 'died':
+                log.error("Kernel died.")
+                return 1
+
+
+def start_client():
+    """
+    Run the kernel on the command line through the daemon. Only the
+    options for the client are looked at here and the daemon parses the
+    rest, so the client never loads the kernel machinery.
+    """
+    argv = sys.argv[1:]
+    socket_path = None
+    if '--daemon-socket' in argv[:-1]:
+        socket_path = argv[argv.index('--daemon-socket') + 1]
+
+    log = logging.getLogger('remote_ikernel')
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(_CLIENT_LOG_FMT, '%H:%M:%S'))
+    log.handlers = [console]
+    log.setLevel(logging.DEBUG if '--verbose' in argv else logging.INFO)
+
+    sys.exit(run_client(argv, socket_path))
+
+
+def start_daemon():
+    """
+    Read command line arguments and run the daemon in the foreground.
+    """
+    parser = argparse.ArgumentParser(
+        prog='%prog daemon',
+        description="Shared supervisor for remote_ikernel kernels.")
+    parser.add_argument('--socket', help="Path of the socket that kernels "
+                        "register through.")
+    parser.add_argument('--interval', type=int, default=DEFAULT_INTERVAL,
+                        help="Seconds between health checks.")
+
+    # Temporarily remove 'daemon' from the arguments
+    raw_args = sys.argv[:]
+    sys.argv.remove('daemon')
+    args = parser.parse_args()
+    sys.argv = raw_args
+
+    from remote_ikernel.kernel import _setup_logging
+    _setup_logging(False)
+
+    daemon = SupervisorDaemon(args.socket, args.interval)
+    if not daemon.bind():
+        print("A daemon is already running on {0}.".format(daemon.socket_path))
+        return
+
+    def _terminate(signum, _):
+        """Exit through the clean up below."""
+        raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        daemon.serve_forever()
+    finally:
+        os.remove(daemon.socket_path)
+        # Kernels are not left running without a supervisor
+        daemon.shutdown()
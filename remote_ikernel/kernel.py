@@ -8,11 +8,19 @@ job schedulers.
 """
 
 import argparse
+import ctypes
+import ctypes.util
+import hashlib
 import json
 import logging
 import os
 import re
+import shlex
+import signal
+import socket
 import subprocess
+import sys
+import threading
 import time
 
 import pexpect
@@ -20,6 +28,10 @@ import pexpect
 from tornado.log import LogFormatter
 
 from remote_ikernel import RIK_PREFIX, __version__
+from remote_ikernel.daemon import runtime_dir
+from remote_ikernel.metrics import (channel_bytes, format_prometheus,
+                                    supervisor_usage)
+from remote_ikernel.replay import Transcript
 
 # Where remote system has a different filesystem, a temporary file is needed
 # to hold the json.
@@ -28,6 +40,110 @@ TEMP_KERNEL_NAME = './{0}kernel.json'.format(RIK_PREFIX)
 PORT_NAMES = ['hb_port', 'shell_port', 'iopub_port', 'stdin_port',
               'control_port']
 
+# Shell loop that samples the kernel resource usage from /proc. It runs
+# in the background of the 'sh -c' that exec's the kernel, so $$ is the
+# kernel PID. Fields: time, clock ticks per second, cpu ticks, RSS (kB),
+# threads, open files.
+TELEMETRY_SAMPLER = (
+    "while kill -0 $$ 2>/dev/null; do "
+    "echo rik_telemetry $(date +%s) $(getconf CLK_TCK) "
+    "$(awk '{{print $14+$15}}' /proc/$$/stat 2>/dev/null) "
+    "$(awk '/^VmRSS/{{r=$2}} /^Threads/{{t=$2}} END{{print r+0, t+0}}' "
+    "/proc/$$/status 2>/dev/null) "
+    "$(ls /proc/$$/fd 2>/dev/null | wc -l); "
+    "sleep {interval}; done")
+# Digits only, so the echo of the command itself is never matched
+TELEMETRY_RE = r'rik_telemetry (\d+) (\d+) (\d+) (\d+) (\d+)\s+(\d+)'
+# Reported by the shell that exec's the kernel, so it is the kernel PID;
+# the line end makes sure all the digits have arrived
+KERNEL_PID_RE = r'rik_kernel_pid (\d+)\s'
+# How long to wait for the kernel to be signalled over ssh, in the
+# background
+INTERRUPT_TIMEOUT = 10
+# How long a stopped kernel's session gets to write staged files back
+# before it is closed anyway
+WRITEBACK_WAIT = 300
+# How long a restarted tunnel gets to ask for a password; the login has
+# already worked once, so any prompt comes quickly
+TUNNEL_PASSWORD_WAIT = 2
+# From linux/prctl.h, signal a process when its parent dies
+PR_SET_PDEATHSIG = 1
+# Warn when the kernel RSS goes above this fraction of the memory limit
+MEM_WARN_FRACTION = 0.9
+# Let the remote machine pick free ports for the kernel. The sockets are
+# closed straight away and the ports handed to the kernel, so another
+# process on the node could still take one before the kernel binds it.
+PORT_PROBE = (
+    "$(command -v python3 || command -v python) -c "
+    "'import socket; sockets = [socket.socket() for _ in range({0})]; "
+    "[sock.bind((\"\", 0)) for sock in sockets]; "
+    "print(\"rik_ports \" + \" \".join(str(sock.getsockname()[1]) "
+    "for sock in sockets))'".format(len(PORT_NAMES)))
+PORTS_RE = r'rik_ports' + r' (\d+)' * len(PORT_NAMES)
+# Kernels that bind any free port when given port 0, and write the ports
+# back to the connection file (like ipykernel), leave no gap for another
+# process to take them. This waits for the ports to appear in the file.
+PORT_READER = (
+    "import json, time\n"
+    "for _ in range({tries}):\n"
+    "    try:\n"
+    "        info = json.load(open({connection_file!r}))\n"
+    "    except (IOError, ValueError):\n"
+    "        info = {{}}\n"
+    "    ports = [info.get(name, 0) for name in {port_names!r}]\n"
+    "    if all(ports):\n"
+    "        print('rik_ports ' + ' '.join(str(port) for port in ports))\n"
+    "        break\n"
+    "    time.sleep(0.2)\n")
+# How long a kernel gets to write its ports
+PORT_WAIT = 120
+# Number of recent tunnel outages kept in the stats
+STATS_OUTAGES = 20
+# Traffic on these means someone is using the kernel
+IDLE_CHANNELS = ['shell_port', 'iopub_port']
+# Channels held open by the supervisor once a kernel has been released, as
+# (socket bound for the notebook, socket connected to the kernel), so that
+# requests and output are not lost while the kernel is relaunched
+RELAY_CHANNELS = {'shell_port': ('ROUTER', 'DEALER'),
+                  'iopub_port': ('XPUB', 'XSUB'),
+                  'stdin_port': ('ROUTER', 'DEALER')}
+# The kernel sends input requests to whoever sent the shell request, so the
+# relay connects to shell and stdin under the same name
+RELAY_IDENTITY = '{0}relay'.format(RIK_PREFIX).encode('ascii')
+# How long requests are held for a resumed kernel to connect its output
+RELAY_WAIT = 60
+# Node-local scratch where inputs are staged, expanded on the remote machine
+DEFAULT_STAGE_ROOT = '${TMPDIR:-/tmp}'
+# Kernel output is kept in two rotating segments on the node, each
+# holding about half of the limit. The segment being written is plain text,
+# written unbuffered so it can be read while the kernel runs; once full it
+# is compressed, replacing the previous one. Reads from the fifo that the
+# kernel writes to.
+SPOOLER = (
+    "import gzip, os, shutil\n"
+    "log = {log!r}\n"
+    "fifo = os.open(log + '.fifo', os.O_RDONLY)\n"
+    "os.remove(log + '.fifo')\n"
+    "segment, size = open(log, 'wb', 0), 0\n"
+    "while True:\n"
+    "    data = os.read(fifo, 65536)\n"
+    "    if not data:\n"
+    "        break\n"
+    "    segment.write(data)\n"
+    "    size += len(data)\n"
+    "    if size >= {half}:\n"
+    "        segment.close()\n"
+    "        archive = gzip.open(log + '.tmp.gz', 'wb')\n"
+    "        shutil.copyfileobj(open(log, 'rb'), archive)\n"
+    "        archive.close()\n"
+    "        os.rename(log + '.tmp.gz', log + '.0.gz')\n"
+    "        segment, size = open(log, 'wb', 0), 0\n")
+# Location of the spool, the echoed command has a quote before the path
+SPOOL_RE = r'rik_spool (/\S+)\s'
+# How much of the spooled output to show, and how long to wait for it
+SPOOL_TAIL_LINES = 50
+SPOOL_FETCH_TIMEOUT = 30
+
 # Blend in with the notebook logging
 _LOG_FMT = ("%(color)s[%(levelname)1.1s %(asctime)s.%(msecs).03d "
             "%(name)s]%(end_color)s %(message)s")
@@ -51,9 +167,33 @@ def _setup_logging(verbose):
 
     log.handlers = []
     log.addHandler(console)
+    _file_like(log)
+
+    return log
 
-    # So that we can attach these to pexpect for debugging purposes
-    # we need to make them look like files
+
+def _kernel_logger(name, verbose):
+    """
+    Logger for one of the kernels in the shared daemon, named after its
+    connection file. Messages go through the handler of the
+    remote_ikernel logger, which the daemon sets up once, at the level
+    that the kernel asked for.
+    """
+    log = logging.getLogger('remote_ikernel.{0}'.format(name))
+    if verbose:
+        log.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.INFO)
+    _file_like(log)
+
+    return log
+
+
+def _file_like(log):
+    """
+    So that we can attach a logger to pexpect for debugging purposes
+    we need to make it look like a file.
+    """
     def _write(*args, **_):
         """
         Method to attach to a logger to allow it to act like a file object.
@@ -75,7 +215,107 @@ def _setup_logging(verbose):
     log.write = _write
     log.flush = _pass
 
-    return log
+
+def _shell_quote(text):
+    """
+    Quote text so that it is a single argument to a POSIX shell.
+    """
+    return "'{0}'".format(text.replace("'", "'\\''"))
+
+
+def _remote_python(code):
+    """
+    Build a shell command that runs some python code with whichever python
+    the remote machine has.
+
+    Parameters
+    ----------
+    code : str
+        Python source, may be several lines.
+
+    Returns
+    -------
+    command : str
+        Shell command line.
+    """
+    return '$(command -v python3 || command -v python) -c {0}'.format(
+        _shell_quote('exec({0!r})'.format(code)))
+
+
+def _exit_on_signal(signum, _):
+    """
+    Signal handler that exits by raising SystemExit, so that the kernel
+    is shut down and files are finished on the way out.
+    """
+    raise SystemExit(128 + signum)
+
+
+def _child_setup():
+    """
+    Return a function for Popen's preexec_fn that puts a child kernel in
+    its own process group, so interrupts only arrive through us, and, on
+    Linux, has it sent SIGTERM if we die without getting to stop it.
+    """
+    parent = os.getpid()
+    prctl = None
+    # Parent death means the death of the thread that started the child,
+    # so only use it from the main thread.
+    if (sys.platform.startswith('linux') and
+            threading.current_thread().name == 'MainThread'):
+        try:
+            prctl = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True).prctl
+        except (OSError, AttributeError):
+            pass
+
+    def _setup():
+        """Run in the child before the kernel starts."""
+        os.setpgrp()
+        if prctl is not None:
+            prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+            # Parent already gone before the signal was set up
+            if os.getppid() != parent:
+                os._exit(1)
+
+    return _setup
+
+
+def _write_json(filename, data):
+    """
+    Write data to a json file, replacing it atomically so that
+    readers never see a partial file.
+    """
+    temp_filename = '{0}.tmp'.format(filename)
+    with open(temp_filename, 'w') as json_file:
+        json.dump(data, json_file, sort_keys=True, indent=2)
+    os.rename(temp_filename, filename)
+
+
+def _free_port():
+    """Return a local port that nothing is listening on right now."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _relay(pairs, stop):
+    """
+    Pass zmq messages both ways between pairs of sockets until stop is
+    set. Runs in its own thread, which owns the sockets while it runs.
+    """
+    import zmq
+    poller = zmq.Poller()
+    targets = {}
+    for frontend, backend in pairs:
+        targets[frontend] = backend
+        targets[backend] = frontend
+        poller.register(frontend, zmq.POLLIN)
+        poller.register(backend, zmq.POLLIN)
+    while not stop.is_set():
+        for sock, _ in poller.poll(100):
+            targets[sock].send_multipart(sock.recv_multipart())
 
 
 def get_password(prompt):
@@ -103,7 +343,7 @@ def get_password(prompt):
     return password
 
 
-def check_password(connection):
+def check_password(connection, timeout=-1):
     """
     Check to see if a newly spawned process requires a password and retrieve
     it from the user if it does. Send the password to the process and
@@ -113,6 +353,9 @@ def check_password(connection):
     ----------
     connection : pexpect.spawn
         The connection to check. Requires an expect and sendline method.
+    timeout : float, optional
+        How long to wait for output each time; -1 uses the timeout of
+        the connection.
 
     """
     # This will loop until no more passwords are encountered
@@ -122,7 +365,7 @@ def check_password(connection):
             # Assume that immediate output includes the
             # request for a password, or goes straight to
             # a prompt.
-            text = connection.read_nonblocking(99999)
+            text = connection.read_nonblocking(99999, timeout)
         except pexpect.TIMEOUT:
             # Nothing more to read from the output
             return
@@ -150,17 +393,42 @@ class RemoteIKernel(object):
     def __init__(self, connection_info=None, interface='sge', cpus=1, pe='smp',
                  kernel_cmd='ipython kernel', workdir=None, tunnel=True,
                  host=None, precmd=None, launch_args=None, verbose=False,
-                 tunnel_hosts=None):
+                 tunnel_hosts=None, telemetry_interval=None,
+                 telemetry_file=None, mem_limit=None, cwd=None,
+                 control_path=None, remote_ports=False, stage=None,
+                 stage_root=DEFAULT_STAGE_ROOT, stage_writeback=False,
+                 record=None, replay=None, replay_speed=1.0,
+                 stats_format=None, stats_dir=None, stats_interval=30,
+                 idle_timeout=None, spool_output=None, env=None,
+                 join_cmd=None, logger=None):
         """
         Initialise a kernel on a remote machine and start tunnels.
 
         """
 
-        self.log = _setup_logging(verbose)
+        # The shared daemon gives each kernel a logger of its own
+        if logger is None:
+            logger = _setup_logging(verbose)
+        self.log = logger
         self.log.info("Remote kernel version: {0}.".format(__version__))
         self.log.info("File location: {0}.".format(__file__))
         # The connection info is provided by the notebook
+        self.connection_file = connection_info
         self.connection_info = json.load(open(connection_info))
+        # Information given to the kernel, ports may differ from the
+        # local ones if they are chosen on the remote machine
+        # 'probe' or 'kernel', see PORT_PROBE and PORT_READER
+        if remote_ports is True:
+            remote_ports = 'probe'
+        self.remote_ports = remote_ports
+        self.remote_connection_info = dict(self.connection_info)
+        if remote_ports == 'kernel':
+            # Several kernels can share a directory and rewrite their files
+            self.host_connection_file = './{0}{1}.json'.format(
+                RIK_PREFIX,
+                os.path.splitext(os.path.basename(connection_info))[0])
+        else:
+            self.host_connection_file = TEMP_KERNEL_NAME
         self.interface = interface
         self.cpus = cpus
         self.pe = pe
@@ -168,13 +436,127 @@ class RemoteIKernel(object):
         self.host = host  # Name of node to be changed once connection is ready.
         self.tunnel_hosts = tunnel_hosts
         self.connection = None  # will usually be a spawned pexpect
+        self.process = None  # kernel run directly by the 'exec' interface
         self.workdir = workdir
         self.tunnel = tunnel
         self.tunnels = {}  # Processes running the SSH tunnels
+        # Existing ssh master connection to the host to multiplex through
+        self.control_path = control_path
+        # Turns the session into one inside a job that is already running
+        self.join_cmd = join_cmd
         self.precmd = precmd
         self.launch_args = launch_args
-        self.cwd = os.getcwd()  # Launch directory may be needed if no workdir
+        # Environment for everything that is run locally, None to inherit
+        self.env = env
+        # Inputs to copy into node-local scratch before starting
+        self.stage = stage
+        self.stage_root = stage_root
+        self.stage_writeback = stage_writeback
+        # Launch directory may be needed if no workdir
+        self.cwd = cwd or os.getcwd()
+        # Resource sampling of the remote kernel process
+        self.telemetry_interval = telemetry_interval
+        if telemetry_file is None:
+            telemetry_file = '{0}.telemetry.json'.format(
+                os.path.splitext(connection_info)[0])
+        self.telemetry_file = telemetry_file
+        self.mem_limit = mem_limit  # MB
+        self.telemetry = {}  # Most recent sample
+        self._mem_warned = False
+        # Transcripts of the session for offline testing
+        self.record = record
+        self.replay = replay
+        self.replay_speed = replay_speed
+        self.transcript = None
+        if self.replay:
+            # Nothing real to tunnel to
+            self.tunnel = False
+        self.timings = {}  # Duration of each launch phase
+        # Runtime metrics, published periodically to a file
+        self.started = time.time()
+        self.stats_format = stats_format
+        self.stats_file = None
+        if stats_format:
+            if stats_dir is None:
+                stats_dir = os.path.dirname(connection_info)
+            self.stats_file = os.path.join(stats_dir, '{0}.stats.{1}'.format(
+                os.path.splitext(os.path.basename(connection_info))[0],
+                stats_format))
+        self.stats_interval = stats_interval
+        self._next_stats = 0
+        self.tunnel_restarts = 0
+        self.tunnel_outages = []  # Recent outage durations
+        self.tunnel_outage_total = 0.0
+        self._tunnel_alive_at = None  # Last time the tunnel was seen
+        # Give up the allocation when nobody is using the kernel
+        self.idle_timeout = idle_timeout
+        self.released = False
+        self.idle_releases = 0
+        self.resume_latency = None
+        self._activity = None  # Bytes through the IDLE_CHANNELS
+        self._last_activity = time.time()
+        self._poll_timeout = 5
+        self._zmq_context = None
+        # Once released, the shell, iopub and stdin ports are held here and
+        # relayed to the kernel, so nothing is lost while it is relaunched
+        self.relay_sockets = {}  # Bound to the notebook's ports
+        self.relay_ports = {}  # Local ends of the tunnels when relayed
+        self._relay = None
+        self._relay_backends = []
+        self._resumer = None  # Thread relaunching a released kernel
+        self._resume_error = None
+        self._relay_stop = threading.Event()
+        # Interrupts are signalled straight to the kernel process
+        self.kernel_pid = None
+        self._interrupter = None  # Thread waiting on a remote kill
+        self._ender = None  # Thread ending the session of a released kernel
+        # Own ssh master for the tunnel, when there is no shared one
+        self.tunnel_master = None
+        self.interrupts = 0
+        self.interrupt_latency = None
+        # Kernel output kept on the node rather than sent over the session
+        self.spool_output = spool_output  # MB
+        self.spool_file = None
+
+        try:
+            start_time = time.time()
+            self.launch()
+            self.timings['launch'] = time.time() - start_time
+
+            # If we've established a connection, start the kernel!
+            if self.connection is not None:
+                start_time = time.time()
+                self.start_kernel()
+                self.timings['start_kernel'] = time.time() - start_time
+                if self.tunnel:
+                    start_time = time.time()
+                    self.tunnel_connection()
+                    self.timings['tunnel'] = time.time() - start_time
+        except pexpect.EOF:
+            self.shutdown()
+            if self.replay:
+                raise RuntimeError("Recording {0} ends before the kernel was "
+                                   "started.".format(self.replay))
+            raise
+        except BaseException:
+            # Stop anything that did start and finish the transcript, which
+            # shows what went wrong
+            self.shutdown()
+            raise
+
+        timings = ", ".join(["{0} {1:.3f} s".format(phase, self.timings[phase])
+                             for phase in sorted(self.timings)])
+        if self.replay:
+            self.log.info("Replayed launch at {0}x: {1}.".format(
+                self.replay_speed, timings))
+        else:
+            self.log.debug("Launch timings: {0}.".format(timings))
 
+    def launch(self):
+        """
+        Establish a session on the machine that will run the kernel
+        using the chosen interface.
+        """
         # Initiate an ssh tunnel through any tunnel hosts
         # this will start a pexpect, so we must check if
         # self.connection exists when launching the interface
@@ -183,6 +565,8 @@ class RemoteIKernel(object):
 
         if self.interface == 'local':
             self.launch_local()
+        elif self.interface == 'exec':
+            self.launch_exec()
         elif self.interface == 'pbs':
             self.launch_pbs()
         elif self.interface == 'sge':
@@ -192,13 +576,16 @@ class RemoteIKernel(object):
         elif self.interface == 'slurm':
             self.launch_slurm()
         else:
-            raise ValueError("Unknown interface {0}".format(interface))
+            raise ValueError("Unknown interface {0}".format(self.interface))
 
-        # If we've established a connection, start the kernel!
-        if self.connection is not None:
-            self.start_kernel()
-            if self.tunnel:
-                self.tunnel_connection()
+        # Packed kernels run inside the job that holds their cpus
+        if self.join_cmd:
+            self.log.info("Joining job: '{0}'.".format(self.join_cmd))
+            self.connection.sendline(self.join_cmd)
+
+        # Names from pexpect are bytes in Python 3
+        if hasattr(self.host, 'decode'):
+            self.host = self.host.decode('utf-8')
 
     def launch_tunnel_hosts(self):
         """
@@ -223,6 +610,30 @@ class RemoteIKernel(object):
         # Don't try and start tunnels to the same machine. Causes issues.
         self.tunnel = False
 
+    def launch_exec(self):
+        """
+        Run the kernel directly as a child process on the local machine,
+        with no shell session. The connection file is passed on as is, so
+        any transport, including ipc, works.
+        """
+        self.log.info("Launching local kernel directly.")
+        kernel_init = self.kernel_cmd.format(
+            host_connection_file=self.connection_file,
+            ci=self.connection_info)
+        # A pre-command needs a shell, but exec still leaves just the kernel
+        if self.precmd:
+            argv = ['/bin/sh', '-c', '{0}; exec {1}'.format(self.precmd,
+                                                            kernel_init)]
+        else:
+            argv = shlex.split(kernel_init)
+        self.log.info("Running kernel command: '{0}'.".format(kernel_init))
+        # Own process group so interrupts only arrive through us, the same
+        # as kernels in a pty session, but ended with us.
+        self.process = subprocess.Popen(argv, cwd=self.workdir or self.cwd,
+                                        env=self.env,
+                                        preexec_fn=_child_setup())
+        self.tunnel = False
+
     def launch_ssh(self):
         """
         Initialise a connection through ssh.
@@ -234,6 +645,8 @@ class RemoteIKernel(object):
             launch_args = self.launch_args
         else:
             launch_args = ''
+        if self.control_path:
+            launch_args = '-S {0} {1}'.format(self.control_path, launch_args)
         login_cmd = 'ssh -o StrictHostKeyChecking=no {args} {host}'.format(
             args=launch_args, host=self.host)
         self.log.debug("Login command: '{0}'.".format(login_cmd))
@@ -345,12 +758,26 @@ class RemoteIKernel(object):
             self.log.info("Current working directory {0}.".format(self.cwd))
             conn.sendline('cd {0}'.format(self.cwd))
 
+        # Kernel runs in the scratch copy, if it worked
+        if self.stage:
+            self.log.info("Staging {0} into {1}.".format(" ".join(self.stage),
+                                                         self.stage_dir))
+            conn.sendline(self.stage_cmd)
+
+        # Ports only need to match if the kernel is reached directly
+        kernel_ports = self.remote_ports == 'kernel' and self.tunnel
+        if self.remote_ports == 'probe' and self.tunnel:
+            self.negotiate_ports()
+        elif kernel_ports:
+            for port_name in PORT_NAMES:
+                self.remote_connection_info[port_name] = 0
+
         # Create a temporary file to store a copy of the connection information
         # Delete the file if it already exists
-        conn.sendline('rm -f {0}'.format(TEMP_KERNEL_NAME))
-        file_contents = json.dumps(self.connection_info)
+        conn.sendline('rm -f {0}'.format(self.host_connection_file))
+        file_contents = json.dumps(self.remote_connection_info)
         conn.sendline('echo \'{0}\' > {1}'.format(file_contents,
-                                                  TEMP_KERNEL_NAME))
+                                                  self.host_connection_file))
 
         # Is this the best place for a pre-command? I guess people will just
         # have to deal with it. Pass it on as is.
@@ -359,24 +786,193 @@ class RemoteIKernel(object):
 
         # Init as a background process so we can delete the tempfile after
         kernel_init = '{kernel_cmd}'.format(kernel_cmd=self.kernel_cmd)
-        kernel_init = kernel_init.format(host_connection_file=TEMP_KERNEL_NAME,
-                                         ci=self.connection_info)
+        kernel_init = kernel_init.format(
+            host_connection_file=self.host_connection_file,
+            ci=self.remote_connection_info)
         self.log.info("Running kernel command: '{0}'.".format(kernel_init))
+        # Start the kernel from a shell that reports its PID and runs any
+        # sidecars; exec keeps the PID the same so they refer to the kernel.
+        wrapper = ['echo rik_kernel_pid $$;']
+        if self.telemetry_interval:
+            wrapper.append('{0} &'.format(TELEMETRY_SAMPLER.format(
+                interval=self.telemetry_interval)))
+        if kernel_ports:
+            reader = PORT_READER.format(
+                tries=PORT_WAIT * 5, port_names=PORT_NAMES,
+                connection_file=self.host_connection_file)
+            wrapper.append('{0} &'.format(_remote_python(reader)))
+        if self.spool_output and self.start_spool():
+            wrapper.append('rm -f {0} {0}.0.gz {0}.fifo; '
+                           'mkfifo {0}.fifo;'.format(self.spool_file))
+            wrapper.append('{0} &'.format(_remote_python(SPOOLER.format(
+                log=self.spool_file,
+                half=self.spool_output * 1024 * 1024 // 2))))
+            wrapper.append('exec {0} > {1}.fifo 2>&1'.format(
+                kernel_init, self.spool_file))
+        else:
+            wrapper.append('exec {0}'.format(kernel_init))
+        kernel_init = 'sh -c {0}'.format(_shell_quote(" ".join(wrapper)))
+        self.log.debug("Kernel wrapper: '{0}'.".format(kernel_init))
+        self.kernel_pid = None
         conn.sendline(kernel_init)
+        self.read_kernel_pid()
+        if kernel_ports:
+            self.read_kernel_ports()
 
         # The kernel blocks further commands, so queue deletion of the
         # transient file for once the process stops. Trying to do this
         # whilst simultaneously starting the kernel ended up deleting
         # the file before it was read.
-        conn.sendline('rm -f {0}'.format(TEMP_KERNEL_NAME))
+        conn.sendline('rm -f {0}'.format(self.host_connection_file))
+        if self.stage and self.stage_writeback:
+            conn.sendline(self.writeback_cmd)
         conn.sendline('exit')
 
         # Could check this for errors?
         conn.expect('exit')
 
-    def tunnel_connection(self):
+    def negotiate_ports(self):
+        """
+        Ask the remote machine for free ports for the kernel to use. The
+        tunnels will map the local ports onto these. If nothing comes back
+        the local port numbers are kept.
+        """
+        conn = self.connection
+        conn.sendline(PORT_PROBE)
+        try:
+            conn.expect(PORTS_RE, timeout=30)
+        except pexpect.TIMEOUT:
+            self.log.warning("No free ports reported by the remote machine; "
+                             "using the local port numbers.")
+            return
+
+        for port_name, port in zip(PORT_NAMES, conn.match.groups()):
+            self.remote_connection_info[port_name] = int(port)
+        self.log.info("Remote ports: {0}.".format(", ".join(
+            ["{0}".format(self.remote_connection_info[port_name])
+             for port_name in PORT_NAMES])))
+
+    def read_kernel_pid(self):
+        """
+        Wait for the kernel wrapper to report the PID of the kernel, before
+        anything else is sent to the session, so that interrupts can go
+        straight to the kernel.
+        """
+        try:
+            self.connection.expect(KERNEL_PID_RE, timeout=30)
+        except pexpect.TIMEOUT:
+            self.log.warning("Kernel PID was not reported; interrupts will "
+                             "be typed into the session.")
+            return
+        self.kernel_pid = int(self.connection.match.groups()[0])
+        self.log.info("Kernel running with PID {0}.".format(self.kernel_pid))
+
+    def read_kernel_ports(self):
+        """
+        Wait for the ports that the kernel has bound, as written to its
+        connection file and reported by PORT_READER. The tunnels need
+        them, so the launch fails if they never come.
+        """
+        try:
+            self.connection.expect(PORTS_RE, timeout=PORT_WAIT)
+        except pexpect.TIMEOUT:
+            raise RuntimeError("The kernel did not write its ports to the "
+                               "connection file; use '--remote-ports probe' "
+                               "for kernels that cannot choose their own.")
+        for port_name, port in zip(PORT_NAMES, self.connection.match.groups()):
+            self.remote_connection_info[port_name] = int(port)
+        self.log.info("Kernel bound ports: {0}.".format(", ".join(
+            ["{0}".format(self.remote_connection_info[port_name])
+             for port_name in PORT_NAMES])))
+
+    def start_spool(self):
+        """
+        Find the full path of the file to spool kernel output to, in the
+        working directory, so that it can be fetched from outside the
+        session.
+
+        Returns
+        -------
+        found : bool
+            False if the path could not be found and the kernel should run
+            without a spool.
+        """
+        # A spool from before a resume belongs to the old session
+        self.spool_file = None
+        conn = self.connection
+        conn.sendline('echo rik_spool "$PWD"/rik_{0}.log'.format(
+            os.path.splitext(os.path.basename(self.connection_file))[0]))
+        try:
+            conn.expect(SPOOL_RE, timeout=30)
+        except pexpect.TIMEOUT:
+            self.log.warning("Unable to find the working directory; kernel "
+                             "output will not be spooled.")
+            return False
+        self.spool_file = conn.match.groups()[0]
+        if hasattr(self.spool_file, 'decode'):
+            self.spool_file = self.spool_file.decode('utf-8')
+        self.log.info("Spooling kernel output to {0}, older output to "
+                      "{0}.0.gz.".format(self.spool_file))
+        return True
+
+    def fetch_spool(self, lines=SPOOL_TAIL_LINES):
+        """
+        Get the end of the kernel output from the spool on the remote
+        machine, over a new connection.
+
+        Parameters
+        ----------
+        lines : int
+            Number of lines from the end of the output to return.
+
+        Returns
+        -------
+        output : list of str
+            The last lines of output, empty if they could not be read.
+        """
+        if self.spool_file is None or self.replay:
+            return []
+        # Previous segment, if the output has rotated, then the live one
+        command = ('{{ gzip -dc {0}.0.gz; cat {0}; }} 2>/dev/null | '
+                   'tail -n {1}'.format(self.spool_file, lines))
+        if self.interface == 'local':
+            command = 'sh -c {0}'.format(_shell_quote(command))
+        else:
+            command = self.remote_command(command)
+        try:
+            output = pexpect.run(command, timeout=SPOOL_FETCH_TIMEOUT,
+                                 env=self.env)
+        except pexpect.ExceptionPexpect as error:
+            self.log.warning("Unable to fetch kernel output: {0}.".format(
+                error))
+            return []
+        if hasattr(output, 'decode'):
+            output = output.decode('utf-8', 'replace')
+        return output.splitlines()
+
+    def show_spool(self, level=logging.INFO):
+        """
+        Log the end of the spooled kernel output.
+        """
+        lines = self.fetch_spool()
+        self.log.log(level, "Last {0} lines of kernel output:".format(
+            len(lines)))
+        for line in lines:
+            self.log.log(level, line)
+
+    def _handle_show_spool(self, *_):
+        """Signal handler that logs the recent kernel output."""
+        self.show_spool()
+
+    def tunnel_connection(self, password_timeout=-1):
         """
         Set up tunnels to the node using the connection information.
+
+        Parameters
+        ----------
+        password_timeout : float, optional
+            How long to wait for a password prompt; -1 uses the pexpect
+            default. Silent key logins take this long to return.
         """
         # Auto accept ssh keys so tunnels work on previously unknown hosts.
         # This might need to change, but the other option is to get user or
@@ -384,16 +980,34 @@ class RemoteIKernel(object):
         # to work seamlessly. (tunnels will have already done this)
         pre = self.tunnel_hosts_cmd or ''
         pexpect.spawn('{pre} ssh -o StrictHostKeyChecking=no '
-                      '{host}'.format(pre=pre, host=self.host).strip()).sendline('exit')
+                      '{host}'.format(pre=pre, host=self.host).strip(),
+                      env=self.env).sendline('exit')
+
+        # The tunnel's ssh becomes a master that kill can go through
+        if self.tunnel_master is None and self.master_path is None:
+            stem = os.path.splitext(os.path.basename(self.connection_file))[0]
+            try:
+                self.tunnel_master = os.path.join(runtime_dir(),
+                                                  'rik_{0}.ctl'.format(stem))
+            except (OSError, RuntimeError) as error:
+                self.log.debug("No ssh master for the tunnel: {0}.".format(
+                    error))
+        # Left behind if the last tunnel was killed outright
+        if self.tunnel_master and os.path.exists(self.tunnel_master):
+            os.remove(self.tunnel_master)
 
         # connection info should have the ports being used
-        tunnel_command = self.tunnel_cmd.format(**self.connection_info)
-        tunnel = pexpect.spawn(tunnel_command)
-        check_password(tunnel)
+        tunnel_command = self.tunnel_cmd
+        tunnel = pexpect.spawn(tunnel_command, env=self.env)
+        check_password(tunnel, password_timeout)
 
         self.log.info("Setting up tunnels on ports: {0}.".format(
             ", ".join(["{0}".format(self.connection_info[port_name])
                        for port_name in PORT_NAMES])))
+        if self.remote_connection_info != self.connection_info:
+            self.log.info("Forwarding to remote ports: {0}.".format(
+                ", ".join(["{0}".format(self.remote_connection_info[port_name])
+                           for port_name in PORT_NAMES])))
         self.log.debug("Tunnel command: {0}.".format(tunnel_command))
 
         # Store the tunnel
@@ -405,53 +1019,673 @@ class RemoteIKernel(object):
         """
         if not self.tunnels['tunnel'].isalive():
             self.log.debug("Restarting ssh tunnels.")
-            self.tunnel_connection()
+            # Outage measured from when the tunnel was last seen working
+            down_since = self._tunnel_alive_at or time.time()
+            # Restarts are routine, they should not hold up a shared daemon
+            self.tunnel_connection(password_timeout=TUNNEL_PASSWORD_WAIT)
+            outage = time.time() - down_since
+            self.tunnel_restarts += 1
+            self.tunnel_outage_total += outage
+            self.tunnel_outages = (self.tunnel_outages + [outage])[
+                -STATS_OUTAGES:]
+            self.log.info("Tunnels restarted after {0:.1f} s outage.".format(
+                outage))
+        self._tunnel_alive_at = time.time()
 
     def keep_alive(self, timeout=5):
         """
-        Keep the script alive forever. KeyboardInterrupt will get passed on
-        to the kernel. The timeout determines how often the ssh tunnels are
-        checked.
-        """
-        # The timeout determines how long each loop will be,
-        # if an ssh tunnel dies, this is how long it will be
-        # before it is revived.
-        self.connection.timeout = timeout
-        time.sleep(timeout)
-
-        # There might be a more elegant way to do this, but since this
-        # process doesn't do anything and is managed by the notebook
-        # it really doesn't matter
-        while True:
-            # If the kernel dies, we should too, but try and
-            # give some error info
-            if not self.connection.isalive():
-                self.log.error("Kernel died.")
-                for line in self.connection.readlines():
-                    if line.strip():
-                        self.log.error(line)
-                break
-            # Kernel is still alive, ensure tunnels are too
+        Keep the script alive forever. SIGINT will get passed on to the
+        kernel as soon as it arrives, and SIGUSR1 logs the recent output of
+        a spooling kernel. The timeout determines how often the ssh tunnels
+        are checked.
+        """
+        signal.signal(signal.SIGINT, self._handle_interrupt)
+        if self.spool_output and hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._handle_show_spool)
+
+        try:
+            # Nothing to poll for a child process, just wait for it
+            if self.process is not None:
+                self.wait_process(timeout)
+            else:
+                # The timeout determines how long each loop will be,
+                # if an ssh tunnel dies, this is how long it will be
+                # before it is revived.
+                self.connection.timeout = timeout
+                # Pick up the kernel PID while waiting, so early interrupts
+                # can go straight to the kernel.
+                settled = time.time() + timeout
+                self.read_output()
+                time.sleep(max(0, settled - time.time()))
+
+                # There might be a more elegant way to do this, but since
+                # this process doesn't do anything and is managed by the
+                # notebook it really doesn't matter
+                while self.poll():
+                    pass
+        except BaseException:
+            # Stopped by the notebook, take everything down with us
+            self.shutdown()
+            raise
+
+        self.cleanup()
+
+    def poll(self):
+        """
+        Run a single supervision step: check the kernel is alive, revive
+        any dead tunnels and consume output. Blocks for at most the
+        connection timeout.
+
+        Returns
+        -------
+        alive : bool
+            False once the kernel has died.
+        """
+        if self.stats_format and time.time() >= self._next_stats:
+            self.write_stats()
+
+        if self.process is not None:
+            if self.process.poll() is None:
+                return True
+            self.log.error("Kernel died with exit code {0}.".format(
+                self.process.returncode))
+            return False
+
+        if self.released:
+            return self.wait_for_wake()
+
+        # If the kernel dies, we should too, but try and
+        # give some error info
+        if not self.connection.isalive():
+            self.log.error("Kernel died.")
+            for line in self.connection.readlines():
+                if line.strip():
+                    self.log.error(line)
+            if self.spool_file is not None:
+                self.show_spool(logging.ERROR)
+            return False
+        # Kernel is still alive, ensure tunnels are too
+        if self.tunnel:
             self.check_tunnels()
+            if self.idle_timeout:
+                self.check_idle()
+                if self.released:
+                    return True
+        self.read_output()
+        return True
+
+    def check_idle(self):
+        """
+        Look for traffic on the shell and iopub tunnels and release the
+        kernel if there has been none for the idle timeout.
+        """
+        channels = channel_bytes(dict(
+            (port_name, self.connection_info[port_name])
+            for port_name in IDLE_CHANNELS))
+        if not channels:
+            self.log.warning("Unable to measure kernel activity; idle kernels "
+                             "will not be released.")
+            self.idle_timeout = None
+            return
+
+        activity = sum(counts['received'] + counts['sent']
+                       for counts in channels.values())
+        now = time.time()
+        if activity != self._activity:
+            self._activity = activity
+            self._last_activity = now
+        elif now - self._last_activity > self.idle_timeout:
+            self.release()
+
+    def release(self):
+        """
+        Stop the kernel and end its session, freeing the allocation, but
+        keep listening on the local shell port so that the next request
+        relaunches it.
+        """
+        try:
+            import zmq
+        except ImportError:
+            self.log.warning("pyzmq is needed to resume idle kernels; "
+                             "keeping the allocation.")
+            self.idle_timeout = None
+            return
+
+        self.log.info("No activity for {0} s; releasing the kernel on "
+                      "{1}.".format(self.idle_timeout, self.host))
+        self.stop_relay()
+        self._poll_timeout = self.connection.timeout
+        # A writeback can take a while, so end the session in the background
+        self._ender = threading.Thread(
+            target=self.end_session,
+            args=(self.connection, list(self.tunnels.values())))
+        self._ender.daemon = True
+        self._ender.start()
+        self.tunnels = {}
+        self.connection = None
+        self.telemetry = {}
+        self.released = True
+        self.idle_releases += 1
+        if self._zmq_context is None:
+            self._zmq_context = zmq.Context()
+
+    def wait_for_wake(self):
+        """
+        While released, wait for a request on the shell port for up to the
+        usual polling time and resume the kernel in a separate thread if
+        one arrives. The request stays queued until the kernel is ready.
+
+        Returns
+        -------
+        alive : bool
+            False if the kernel could not be resumed.
+        """
+        import zmq
+        if self._resumer is not None:
+            # Relaunching can wait in a queue; never hold up the caller
+            self._resumer.join(self._poll_timeout)
+            if self._resumer.is_alive():
+                return True
+            self._resumer = None
+            if self._resume_error is not None:
+                self.log.error("Unable to resume kernel: {0}.".format(
+                    self._resume_error))
+                return False
+            return True
+
+        for port_name, (socket_type, _) in RELAY_CHANNELS.items():
+            if port_name in self.relay_sockets:
+                continue
+            relay_socket = self._zmq_context.socket(getattr(zmq, socket_type))
+            relay_socket.linger = 0
             try:
-                # read anything from the kernel output, pexpect
-                # logging will be set up to emit anything if
-                # required.
+                relay_socket.bind('tcp://127.0.0.1:{0}'.format(
+                    self.connection_info[port_name]))
+            except zmq.ZMQError as error:
+                # Tunnel may not have let go of the port yet
+                self.log.debug("Waiting for {0}: {1}.".format(port_name,
+                                                              error))
+                relay_socket.close()
+                time.sleep(self._poll_timeout)
+                return True
+            self.relay_sockets[port_name] = relay_socket
+
+        if self.relay_sockets['shell_port'].poll(self._poll_timeout * 1000):
+            self._resume_error = None
+            self._resumer = threading.Thread(target=self._resume)
+            self._resumer.daemon = True
+            self._resumer.start()
+        return True
+
+    def _resume(self):
+        """Thread target that resumes the kernel and keeps any error."""
+        try:
+            self.resume()
+        except Exception as error:  # pylint: disable=broad-except
+            self._resume_error = error
+
+    def resume(self):
+        """
+        Relaunch a released kernel. The notebook stays connected to the
+        relay sockets, which are now passed on to tunnels ending on spare
+        local ports, so the requests that queued up while the kernel was
+        starting, and everything after them, reach the kernel, and the
+        replies and output find their way back to the notebook.
+        """
+        import zmq
+        start_time = time.time()
+        self.log.info("Request for released kernel; relaunching.")
+        # Scratch must not change under the previous writeback
+        if self._ender is not None:
+            self._ender.join()
+        # Nothing to signal until the new kernel reports in
+        self.kernel_pid = None
+        for port_name in RELAY_CHANNELS:
+            if port_name not in self.relay_ports:
+                self.relay_ports[port_name] = _free_port()
+
+        self.launch()
+        self.start_kernel()
+        self.tunnel_connection()
+        self.connection.timeout = self._poll_timeout
+        self._tunnel_alive_at = None
+        self._activity = None
+        self._last_activity = time.time()
+
+        # Messages are queued until the tunnel is ready
+        pairs = []
+        monitors = []
+        for port_name, (front_type, socket_type) in RELAY_CHANNELS.items():
+            frontend = self.relay_sockets[port_name]
+            # Output is only sent on for subscriptions that have been read
+            while front_type == 'XPUB' and frontend.poll(0):
+                frontend.recv_multipart()
+            backend = self._zmq_context.socket(getattr(zmq, socket_type))
+            backend.linger = 0
+            if socket_type == 'DEALER':
+                backend.setsockopt(zmq.IDENTITY, RELAY_IDENTITY)
+            if port_name != 'shell_port':
+                monitors.append((backend, backend.get_monitor_socket(getattr(
+                    zmq, 'EVENT_HANDSHAKE_SUCCEEDED', zmq.EVENT_CONNECTED))))
+            backend.connect('tcp://127.0.0.1:{0}'.format(
+                self.relay_ports[port_name]))
+            if socket_type == 'XSUB':
+                # Everything, the notebook filters its own subscriptions
+                backend.send(b'\x01')
+            self._relay_backends.append(backend)
+            pairs.append((frontend, backend))
+
+        # Output and input requests for the waiting requests are lost
+        # unless the kernel can already reach the relay when they arrive
+        deadline = time.time() + RELAY_WAIT
+        connected = True
+        for backend, monitor in monitors:
+            connected = (monitor.poll(max(0, deadline - time.time()) * 1000)
+                         and connected)
+            backend.disable_monitor()
+            monitor.close()
+        if not connected:
+            self.log.warning("Kernel output and input not connected after "
+                             "{0} s; passing on requests anyway.".format(
+                                 RELAY_WAIT))
+        self._relay_stop.clear()
+        self._relay = threading.Thread(target=_relay,
+                                       args=(pairs, self._relay_stop))
+        self._relay.daemon = True
+        self._relay.start()
+        self.released = False
+
+        self.resume_latency = time.time() - start_time
+        self.log.info("Kernel resumed on {0} in {1:.1f} s.".format(
+            self.host, self.resume_latency))
+
+    def stop_relay(self):
+        """
+        Stop relaying to the kernel. The relay sockets stay bound to the
+        notebook's ports to catch the next request.
+        """
+        if self._relay is None:
+            return
+        self._relay_stop.set()
+        self._relay.join()
+        self._relay = None
+        for backend in self._relay_backends:
+            backend.close()
+        self._relay_backends = []
+
+    def local_port(self, port_name):
+        """
+        Local port that the tunnel forwards for a channel. This is the
+        port from the connection file, unless a resumed kernel's channel
+        is relayed.
+        """
+        return self.relay_ports.get(port_name,
+                                    self.connection_info[port_name])
+
+    def wait_process(self, timeout=5):
+        """
+        Block until a directly executed kernel exits. Only wakes up every
+        timeout seconds if there are stats to publish.
+        """
+        while self.poll():
+            if self.stats_format:
+                time.sleep(timeout)
+            else:
+                self.process.wait()
+
+    def read_output(self):
+        """
+        Read anything from the kernel output, pexpect logging will be set
+        up to emit anything if required.
+        """
+        try:
+            if self.telemetry_interval or self.kernel_pid is None:
+                self.read_reports()
+            else:
                 self.connection.readlines()
+        except pexpect.TIMEOUT:
+            # Raises timeout if there is no data, prevents blocking
+            # Moves on to the next loop.
+            pass
+
+    def _handle_interrupt(self, *_):
+        """Signal handler that passes SIGINT on to the kernel."""
+        self.log.info("Caught interrupt; sending to kernel.")
+        self.interrupt()
+
+    def interrupt(self):
+        """
+        Pass an interrupt on to the kernel. The kernel process is sent
+        SIGINT directly if its PID is known, otherwise Ctrl-C is typed
+        into the session. This is called from a signal handler, so
+        nothing here waits on the network. The time for the interrupt to
+        be delivered is logged.
+        """
+        start_time = time.time()
+        if self.process is not None:
+            self.process.send_signal(signal.SIGINT)
+            self.interrupt_delivered("kernel process", start_time)
+        elif self.kernel_pid is not None and not self.replay:
+            # The PID of a recording means nothing here
+            self.interrupt_pid(start_time)
+        elif self.connection is not None:
+            self.interrupt_session(start_time)
+
+    def interrupt_pid(self, start_time):
+        """
+        Send SIGINT to the kernel PID. A remote kernel is signalled with
+        kill over the ssh master connection of the tunnel, in the
+        background, and gets Ctrl-C in its session if that fails.
+
+        Parameters
+        ----------
+        start_time : float
+            When the interrupt arrived, for the latency.
+        """
+        if self.interface == 'local':
+            try:
+                os.kill(self.kernel_pid, signal.SIGINT)
+            except OSError as error:
+                self.log.debug("Unable to signal kernel: {0}.".format(error))
+                self.interrupt_session(start_time)
+            else:
+                self.interrupt_delivered(
+                    "kernel PID {0}".format(self.kernel_pid), start_time)
+            return
+
+        if self._interrupter is not None and self._interrupter.is_alive():
+            self.log.debug("Previous interrupt is still being sent.")
+            return
+        signaller = self.signal_remote('INT')
+        if signaller is None:
+            self.interrupt_session(start_time)
+            return
+        self._interrupter = threading.Thread(
+            target=self._finish_interrupt, args=(signaller, start_time))
+        self._interrupter.daemon = True
+        self._interrupter.start()
+
+    def signal_remote(self, signal_name):
+        """
+        Start sending a signal to the remote kernel PID with kill over the
+        ssh master connection of the tunnel.
+
+        Parameters
+        ----------
+        signal_name : str
+            Name of the signal for kill, e.g. 'INT'.
+
+        Returns
+        -------
+        signaller : subprocess.Popen or None
+            The running kill, or None if it could not be started.
+        """
+        command = self.remote_command('kill -{0} {1}'.format(
+            signal_name, self.kernel_pid))
+        try:
+            with open(os.devnull) as devnull:
+                return subprocess.Popen(
+                    shlex.split(command), stdin=devnull,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    env=self.env, preexec_fn=_child_setup())
+        except OSError as error:
+            self.log.debug("Unable to signal kernel: {0}.".format(error))
+            return None
+
+    def _finish_interrupt(self, signaller, start_time):
+        """
+        Thread target that waits for a remote kill, giving up after
+        INTERRUPT_TIMEOUT, and falls back to the session if it failed.
+        """
+        timer = threading.Timer(INTERRUPT_TIMEOUT, signaller.kill)
+        timer.start()
+        output = signaller.communicate()[0]
+        timer.cancel()
+        if signaller.returncode == 0:
+            self.interrupt_delivered("kernel PID {0}".format(self.kernel_pid),
+                                     start_time)
+            return
+        self.log.debug("Unable to signal kernel: {0!r}.".format(output))
+        if self.connection is not None:
+            self.interrupt_session(start_time)
+
+    def interrupt_session(self, start_time):
+        """
+        Type Ctrl-C into the kernel's session.
+
+        Parameters
+        ----------
+        start_time : float
+            When the interrupt arrived, for the latency.
+        """
+        self.connection.sendcontrol('c')
+        self.interrupt_delivered("session", start_time)
+
+    def interrupt_delivered(self, target, start_time):
+        """
+        Count an interrupt and log how long it took to deliver.
+
+        Parameters
+        ----------
+        target : str
+            Description of what was interrupted.
+        start_time : float
+            When the interrupt arrived.
+        """
+        self.interrupts += 1
+        self.interrupt_latency = time.time() - start_time
+        self.log.info("Interrupt delivered to {0} in {1:.1f} ms.".format(
+            target, 1000 * self.interrupt_latency))
+
+    def shutdown(self):
+        """
+        Stop the tunnels and close the connection to the kernel, which
+        will also end any job that is running it.
+        """
+        self.end_session(self.connection, list(self.tunnels.values()))
+        # A resume gives up once its session has gone; then close whatever
+        # it had already opened
+        if self._resumer is not None:
+            self._resumer.join()
+            self.end_session(self.connection, list(self.tunnels.values()))
+        if self._ender is not None:
+            self._ender.join()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+        self.stop_relay()
+        for relay_socket in self.relay_sockets.values():
+            relay_socket.close()
+        self.relay_sockets = {}
+        if self._zmq_context is not None:
+            self._zmq_context.term()
+            self._zmq_context = None
+        self.cleanup()
+
+    def end_session(self, connection, tunnels):
+        """
+        Close the session of the kernel and its tunnels. Staged files are
+        only written back once the kernel has exited, so with a writeback
+        the kernel is stopped first and the session gets up to
+        WRITEBACK_WAIT to finish before it is closed.
+
+        Parameters
+        ----------
+        connection : pexpect.spawn or None
+            Session that is running the kernel.
+        tunnels : list of pexpect.spawn
+            The ssh tunnels to the kernel.
+        """
+        if (self.stage and self.stage_writeback and connection is not None
+                and connection.isalive()):
+            # The kernel may already have gone if the notebook asked it to
+            self.stop_kernel()
+            self.log.info("Waiting for staged files to be written back.")
+            try:
+                connection.expect(pexpect.EOF, timeout=WRITEBACK_WAIT)
             except pexpect.TIMEOUT:
-                # Raises timeout if there is no data, prevents blocking
-                # Moves on to the next loop.
-                pass
-            except KeyboardInterrupt:
-                self.log.info("Caught interrupt; sending to kernel.")
-                self.connection.sendcontrol('c')
+                self.log.warning("Writeback did not finish in {0} s; staged "
+                                 "files may be incomplete.".format(
+                                     WRITEBACK_WAIT))
+        for tunnel in tunnels:
+            if tunnel.isalive():
+                tunnel.terminate(force=True)
+        if connection is not None and connection.isalive():
+            connection.terminate(force=True)
+
+    def stop_kernel(self):
+        """
+        Send SIGTERM to the kernel PID, waiting up to INTERRUPT_TIMEOUT for
+        a remote kill, so that the rest of the session can run.
+        """
+        if self.kernel_pid is None or self.replay:
+            return
+        if self.interface == 'local':
+            try:
+                os.kill(self.kernel_pid, signal.SIGTERM)
+            except OSError as error:
+                self.log.debug("Unable to stop kernel: {0}.".format(error))
+            return
+        signaller = self.signal_remote('TERM')
+        if signaller is None:
+            return
+        timer = threading.Timer(INTERRUPT_TIMEOUT, signaller.kill)
+        timer.start()
+        output = signaller.communicate()[0]
+        timer.cancel()
+        if signaller.returncode != 0:
+            self.log.debug("Unable to stop kernel: {0!r}.".format(output))
+
+    def cleanup(self):
+        """
+        Finish any files that were written while the kernel was running.
+        """
+        if self.transcript is not None:
+            self.transcript.close()
+        # Stats and samples for a dead kernel would only mislead monitoring
+        if self.stats_format and os.path.exists(self.stats_file):
+            os.remove(self.stats_file)
+        if self.telemetry_interval and os.path.exists(self.telemetry_file):
+            os.remove(self.telemetry_file)
+
+    def get_stats(self):
+        """
+        Collect the runtime metrics of the kernel supervisor.
+
+        Returns
+        -------
+        stats : dict
+            Tunnel restarts and outages, bytes through each channel on
+            open connections, supervisor CPU and memory, launch timings
+            and the latest kernel telemetry.
+        """
+        stats = {
+            'kernel': os.path.splitext(
+                os.path.basename(self.connection_file))[0],
+            'host': self.host,
+            'interface': self.interface,
+            'uptime': time.time() - self.started,
+            'tunnel_restarts': self.tunnel_restarts,
+            'tunnel_outage_seconds_total': self.tunnel_outage_total,
+            'tunnel_last_outage_seconds': (self.tunnel_outages or [0])[-1],
+            'tunnel_outages': self.tunnel_outages,
+            'channel_bytes': {},
+            'supervisor': supervisor_usage(),
+            'timings': self.timings,
+            'kernel_telemetry': self.telemetry,
+            'released': self.released,
+            'idle_releases': self.idle_releases,
+            'last_resume_seconds': self.resume_latency,
+            'interrupts': self.interrupts,
+            'last_interrupt_seconds': self.interrupt_latency}
+        # Only tcp goes through ports
+        if self.connection_info.get('transport', 'tcp') == 'tcp':
+            stats['channel_bytes'] = channel_bytes(dict(
+                (port_name, self.connection_info[port_name])
+                for port_name in PORT_NAMES))
+        return stats
+
+    def write_stats(self):
+        """
+        Publish the current metrics to the stats file, as json or in the
+        Prometheus text format.
+        """
+        self._next_stats = time.time() + self.stats_interval
+        stats = self.get_stats()
+        try:
+            if self.stats_format == 'prom':
+                temp_filename = '{0}.tmp'.format(self.stats_file)
+                with open(temp_filename, 'w') as stats_file:
+                    stats_file.write(format_prometheus(stats))
+                os.rename(temp_filename, self.stats_file)
+            else:
+                _write_json(self.stats_file, stats)
+        except (IOError, OSError) as error:
+            self.log.debug("Could not write stats: {0}.".format(error))
+
+    def read_reports(self):
+        """
+        Wait for the next report from the kernel node, the kernel PID or
+        a resource sample, and record it. Other output is consumed by
+        pexpect logging.
+        """
+        patterns = [pexpect.EOF, TELEMETRY_RE]
+        if self.kernel_pid is None:
+            patterns.append(KERNEL_PID_RE)
+        index = self.connection.expect(patterns)
+        if index == 1:
+            self.update_telemetry(
+                [int(value) for value in self.connection.match.groups()])
+        elif index == 2:
+            self.kernel_pid = int(self.connection.match.groups()[0])
+            self.log.info("Kernel running with PID {0}.".format(
+                self.kernel_pid))
+
+    def update_telemetry(self, values):
+        """
+        Store a resource sample, write it to the telemetry file and warn
+        if the kernel is getting close to the memory limit.
+
+        Parameters
+        ----------
+        values : list of int
+            The fields reported by the sampler: time, clock ticks per
+            second, cpu ticks, RSS in kB, threads and open files.
+        """
+        stamp, clk_tck, cpu_ticks, rss, threads, open_files = values
+        sample = {'time': stamp, 'cpu_ticks': cpu_ticks, 'cpu_percent': None,
+                  'rss_mb': rss / 1024.0, 'threads': threads,
+                  'open_files': open_files, 'host': self.host,
+                  'mem_limit_mb': self.mem_limit}
+        # CPU use is averaged since the previous sample
+        last = self.telemetry
+        if last and stamp > last['time'] and clk_tck:
+            sample['cpu_percent'] = (100.0 * (cpu_ticks - last['cpu_ticks']) /
+                                     clk_tck / (stamp - last['time']))
+        self.telemetry = sample
+
+        try:
+            _write_json(self.telemetry_file, sample)
+        except (IOError, OSError) as error:
+            self.log.debug("Could not write telemetry: {0}.".format(error))
+
+        if self.mem_limit:
+            if sample['rss_mb'] > MEM_WARN_FRACTION * self.mem_limit:
+                if not self._mem_warned:
+                    self.log.warning(
+                        "Kernel is using {0:.0f} MB of {1} MB memory "
+                        "limit.".format(sample['rss_mb'], self.mem_limit))
+                self._mem_warned = True
+            else:
+                self._mem_warned = False
 
     def _spawn(self, command, timeout=600):
         """
         Helper to start a pexpect.spawn as self.connection. If the session
         has already been started, just pass the command to sendline. Return
         the current spawn instance. The logfile is implicitly set to
-        self.log.
+        self.log. When recording, all the output is also written to the
+        transcript; when replaying, the transcript is played back instead
+        of running the command.
 
         Parameters
         ----------
@@ -466,13 +1700,106 @@ class RemoteIKernel(object):
             The connection object. This is also attached to the class.
         """
         if self.connection is None:
-            self.connection = pexpect.spawn(command, timeout=timeout,
-                                            logfile=self.log)
+            if self.replay:
+                # Play back the recorded session in place of the command
+                self.log.debug("Replaying '{0}' from {1}.".format(
+                    command, self.replay))
+                command = '{0} -m remote_ikernel.replay --speed {1} {2}'.format(
+                    sys.executable, self.replay_speed, self.replay)
+                self.connection = pexpect.spawn(command, timeout=timeout,
+                                                logfile=self.log, echo=False,
+                                                env=self.env)
+            else:
+                self.connection = pexpect.spawn(command, timeout=timeout,
+                                                logfile=self.log, env=self.env)
+            if self.record:
+                self.transcript = Transcript(self.record)
+                self.connection.logfile_read = self.transcript
         else:
             self.connection.sendline(command)
 
         return self.connection
 
+    def remote_command(self, command):
+        """
+        Build a command line that runs a command on the kernel's machine
+        through any tunnel hosts. The first hop goes over a master
+        connection if there is one, so it does not need a new login.
+
+        Parameters
+        ----------
+        command : str
+            Shell command to run on the remote machine.
+
+        Returns
+        -------
+        remote_command : str
+            Local command line, quoted for every hop.
+        """
+        hosts = list(self.tunnel_hosts or []) + [self.host]
+        # Wrap from the kernel's machine outwards; never stop for a password
+        for index, host in reversed(list(enumerate(hosts))):
+            ssh = 'ssh -o StrictHostKeyChecking=no -o BatchMode=yes'
+            if ':' in host:
+                host, port = host.split(':')
+                ssh = '{0} -p {1}'.format(ssh, port)
+            if index == 0 and self.master_path:
+                ssh = '{0} -S {1}'.format(ssh, self.master_path)
+            command = '{0} {1} {2}'.format(ssh, host, _shell_quote(command))
+        return command
+
+    @property
+    def master_path(self):
+        """
+        Control socket of an ssh master connection for the first hop
+        towards the kernel: the shared master to the host if there is one,
+        otherwise the tunnel's own, or None.
+        """
+        if self.control_path and not self.tunnel_hosts:
+            return self.control_path
+        return self.tunnel_master
+
+    @property
+    def stage_dir(self):
+        """
+        Scratch directory for staged inputs. The same working directory
+        always gets the same location so files are reused between launches
+        on a node.
+        """
+        source = self.workdir or self.cwd
+        digest = hashlib.md5(source.encode('utf-8')).hexdigest()[:12]
+        return '{0}/rik_stage_${{USER}}_{1}'.format(self.stage_root, digest)
+
+    @property
+    def stage_cmd(self):
+        """
+        Return a command that syncs the staged inputs into scratch and
+        changes into it. rsync only transfers files that have changed and
+        uses delta transfer for those. A shell variable records whether
+        it worked, for the writeback. The scratch location is left for
+        the remote shell to expand.
+        """
+        return ('rik_staged=; mkdir -p "{stage_dir}" && '
+                'rsync -a -R --no-whole-file {paths} "{stage_dir}/" && '
+                'cd "{stage_dir}" && rik_staged=1'.format(
+                    stage_dir=self.stage_dir,
+                    paths=" ".join(_shell_quote(path) for path in self.stage)))
+
+    @property
+    def writeback_cmd(self):
+        """
+        Return a command that copies new and updated files from scratch
+        back to the working directory, only if the kernel was running in
+        scratch. Otherwise the scratch copy could be left from an earlier
+        launch and would overwrite newer files. Our own files are left
+        behind.
+        """
+        return ('[ -n "$rik_staged" ] && rsync -a --update --exclude {0} '
+                '"{1}/" {2}'.format(_shell_quote('{0}*'.format(RIK_PREFIX)),
+                                    self.stage_dir,
+                                    _shell_quote('{0}/'.format(
+                                        self.workdir or self.cwd))))
+
     @property
     def tunnel_hosts_cmd(self):
         """Return the ssh command to tunnel through the middle hosts."""
@@ -494,27 +1821,42 @@ class RemoteIKernel(object):
 
     @property
     def tunnel_cmd(self):
-        """Return a tunnelling command that just needs a port."""
+        """
+        Return a tunnelling command that forwards the local ports onto the
+        ports used by the remote kernel.
+        """
         # zmq needs str in Python 3, but pexpect gives bytes
         if hasattr(self.host, 'decode'):
             self.host = self.host.decode('utf-8')
 
-        # One connection can tunnel all the ports
-        ports_str = " ".join(["-L 127.0.0.1:{{{port}}}:127.0.0.1:{{{port}}}"
-                               "".format(port=port) for port in PORT_NAMES])
+        # One connection can tunnel all the ports. Gateways keep the local
+        # port numbers, only the final hop goes to the remote ports.
+        ports_str = " ".join(["-L 127.0.0.1:{0}:127.0.0.1:{0}".format(
+            self.local_port(port)) for port in PORT_NAMES])
+        host_ports_str = " ".join(["-L 127.0.0.1:{0}:127.0.0.1:{1}".format(
+            self.local_port(port), self.remote_connection_info[port])
+                                   for port in PORT_NAMES])
+
+        # The first hop may be the tunnel's own master, see remote_command
+        if self.tunnel_master:
+            master = '-o ControlMaster=yes -S {0}'.format(self.tunnel_master)
+        else:
+            master = '-S none'
 
         # Add all the gateway machines as an ssh chain
         pre_ssh = []
         for pre_host in self.tunnel_hosts or []:
+            control = master if not pre_ssh else '-S none'
             if ':' in pre_host:
                 # Split the host:port and insert into tunnel command
                 pre_ssh.append(
-                    "ssh -p {1} -S none {ports_str} {1}".format(
-                        pre_host.split(':'), ports_str=ports_str))
+                    "ssh -p {1} {control} {ports_str} {0}".format(
+                        *pre_host.split(':'), control=control,
+                        ports_str=ports_str))
             else:
                 pre_ssh.append(
-                    "ssh -S none {ports_str} {0}".format(
-                        pre_host, ports_str=ports_str))
+                    "ssh {control} {ports_str} {0}".format(
+                        pre_host, control=control, ports_str=ports_str))
 
         if ':' in self.host:
             host, host_port = self.host.split(":")
@@ -523,21 +1865,46 @@ class RemoteIKernel(object):
             ssh = 'ssh '
             host = self.host
 
+        # Forwards can share a master connection that is on this machine
+        if self.control_path and not pre_ssh:
+            control = '-S {0}'.format(self.control_path)
+        elif not pre_ssh:
+            control = master
+        else:
+            control = '-S none'
+
         # Timeout is specified here, this should be longer than the checking
         # interval
         # .strip() to prevent leading spaces
         tunnel_cmd = ((" ".join(pre_ssh) + " " +
-                       "{ssh} -S none {ports_str} {host} sleep 600".format(
-                           ssh=ssh, host=host, ports_str=ports_str)).strip())
+                       "{ssh} {control} {ports_str} {host} sleep 600".format(
+                           ssh=ssh, control=control, host=host,
+                           ports_str=host_ports_str)).strip())
 
         self.log.debug("Tunnel command: {0}".format(tunnel_cmd))
         return tunnel_cmd
 
 
-def start_remote_kernel():
+def parse_kernel_args(argv=None, cwd=None):
     """
-    Read command line arguments and initialise a kernel.
+    Interpret the command line of the kernel launcher.
+
+    Parameters
+    ----------
+    argv : list of str
+        Arguments to parse, defaults to those of this process.
+    cwd : str
+        Directory the launcher was started in, defaults to the current
+        directory. Needed when the arguments come from another process.
+
+    Returns
+    -------
+    args : argparse.Namespace
+        All the parsed arguments.
+    kernel_args : dict
+        Keyword arguments for RemoteIKernel.
     """
+    cwd = cwd or os.getcwd()
     # These will not face a user since they are interpreting the command from
     # kernel the kernel.json
     description = "This is the kernel launcher, did you mean '%prog manage'"
@@ -554,12 +1921,66 @@ def start_remote_kernel():
     parser.add_argument('--launch-args')
     parser.add_argument('--verbose', action='store_true')
     parser.add_argument('--tunnel-hosts', nargs='+')
-    args = parser.parse_args()
-
-    kernel = RemoteIKernel(connection_info=args.connection_info,
-                           interface=args.interface, cpus=args.cpus, pe=args.pe,
-                           kernel_cmd=args.kernel_cmd, workdir=args.workdir,
-                           host=args.host, precmd=args.precmd,
-                           launch_args=args.launch_args, verbose=args.verbose,
-                           tunnel_hosts=args.tunnel_hosts)
+    parser.add_argument('--telemetry-interval', type=int)
+    parser.add_argument('--telemetry-file')
+    parser.add_argument('--mem-limit', type=int)
+    parser.add_argument('--daemon', action='store_true')
+    parser.add_argument('--daemon-socket')
+    parser.add_argument('--pack-cpus', type=int)
+    parser.add_argument('--remote-ports', nargs='?', const='probe',
+                        choices=['probe', 'kernel'])
+    parser.add_argument('--stage', nargs='+')
+    parser.add_argument('--stage-root', default=DEFAULT_STAGE_ROOT)
+    parser.add_argument('--stage-writeback', action='store_true')
+    parser.add_argument('--record')
+    parser.add_argument('--replay')
+    parser.add_argument('--replay-speed', type=float, default=1.0)
+    parser.add_argument('--stats-format', choices=['json', 'prom'])
+    parser.add_argument('--stats-dir')
+    parser.add_argument('--stats-interval', type=int, default=30)
+    parser.add_argument('--idle-timeout', type=int)
+    parser.add_argument('--spool-output', type=int)
+    args = parser.parse_args(argv)
+
+    connection_info = os.path.abspath(os.path.join(cwd, args.connection_info))
+    kernel_args = dict(connection_info=connection_info,
+                       interface=args.interface, cpus=args.cpus, pe=args.pe,
+                       kernel_cmd=args.kernel_cmd, workdir=args.workdir,
+                       host=args.host, precmd=args.precmd,
+                       launch_args=args.launch_args, verbose=args.verbose,
+                       tunnel_hosts=args.tunnel_hosts,
+                       telemetry_interval=args.telemetry_interval,
+                       telemetry_file=args.telemetry_file,
+                       mem_limit=args.mem_limit, cwd=cwd,
+                       remote_ports=args.remote_ports, stage=args.stage,
+                       stage_root=args.stage_root,
+                       stage_writeback=args.stage_writeback,
+                       record=args.record, replay=args.replay,
+                       replay_speed=args.replay_speed,
+                       stats_format=args.stats_format,
+                       stats_dir=args.stats_dir,
+                       stats_interval=args.stats_interval,
+                       idle_timeout=args.idle_timeout,
+                       spool_output=args.spool_output)
+    return args, kernel_args
+
+
+def start_remote_kernel():
+    """
+    Read command line arguments and initialise a kernel.
+    """
+    args, kernel_args = parse_kernel_args()
+
+    if args.daemon:
+        # Hand the kernel over to the shared supervisor and wait on it
+        from remote_ikernel.daemon import start_client
+        start_client()
+    elif args.pack_cpus:
+        _setup_logging(args.verbose).warning(
+            "Packing kernels requires --daemon; using a dedicated job.")
+
+    # The notebook stops kernels with SIGTERM; SIGHUP if the terminal goes
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+    signal.signal(signal.SIGHUP, _exit_on_signal)
+    kernel = RemoteIKernel(**kernel_args)
     kernel.keep_alive()
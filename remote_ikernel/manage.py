@@ -14,15 +14,27 @@ import json
 import os
 import re
 import sys
+import time
 from os import path
 from subprocess import list2cmdline
 
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
 # How we identify kernels that rik will manage
 from remote_ikernel import RIK_PREFIX
 # These go through a compatibility layer to work with IPython and Jupyter
 from remote_ikernel.compat import kernelspec as ks
+from remote_ikernel.compat import manager
 from remote_ikernel.compat import tempdir
 
+# Size of the output used to measure iopub throughput
+BENCHMARK_OUTPUT_SIZE = 10 * 1024 * 1024
+# How long to wait for the launch phase timings after the kernel is ready
+BENCHMARK_STATS_TIMEOUT = 15
+
 
 def delete_kernel(kernel_name):
     """
@@ -71,9 +83,193 @@ def show_kernel(kernel_name):
     print("  * Raw json: {0}".format(json.dumps(kernel_json, indent=2)))
 
 
+def _percentile(values, percent):
+    """
+    Return the value below which the given percentage of values fall,
+    using the nearest rank.
+    """
+    ordered = sorted(values)
+    rank = int(round(percent / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def _wait_for_reply(client, msg_id, timeout):
+    """
+    Return the shell reply to a request, skipping replies to anything else.
+    """
+    deadline = time.time() + timeout
+    while True:
+        reply = client.get_shell_msg(timeout=max(0, deadline - time.time()))
+        if reply['parent_header'].get('msg_id') == msg_id:
+            return reply
+
+
+def _read_timings(stats_file, timeout):
+    """
+    Wait for the kernel supervisor to publish its stats and return the
+    duration of each launch phase, or None if they do not appear.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with open(stats_file) as stats:
+                return json.load(stats)['timings']
+        except (IOError, ValueError, KeyError):
+            time.sleep(0.2)
+    return None
+
+
+def _wait_for_idle(client, msg_id, timeout):
+    """
+    Read iopub until the kernel is idle after a request and return the
+    number of characters of stream output it produced.
+    """
+    deadline = time.time() + timeout
+    output = 0
+    while True:
+        msg = client.get_iopub_msg(timeout=max(0, deadline - time.time()))
+        if msg['parent_header'].get('msg_id') != msg_id:
+            continue
+        if msg['msg_type'] == 'stream':
+            output += len(msg['content']['text'])
+        elif (msg['msg_type'] == 'status' and
+              msg['content']['execution_state'] == 'idle'):
+            return output
+
+
+def benchmark_kernel(kernel_name, requests=100, output_file=None,
+                     timeout=600):
+    """
+    Launch a kernel from its spec, without a notebook, and measure how
+    long it takes to start, and each phase of the launch (for
+    remote_ikernel kernels), the round trip time of trivial execute
+    requests and, for Python kernels, the iopub throughput for a large
+    output. Print a summary and save the results as json.
+
+    Parameters
+    ----------
+    kernel_name : str
+        The name of the kernel to benchmark.
+    requests : int
+        Number of execute requests to time, none if zero.
+    output_file : str
+        Where to save the results, defaults to a timestamped file in the
+        current directory.
+    timeout : int
+        Time to wait for the kernel to start, and for each request.
+
+    Returns
+    -------
+    results : dict
+        All the measurements.
+    """
+    spec = ks.get_kernel_spec(kernel_name)
+    results = {'kernel': kernel_name, 'argv': spec.argv,
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    kernel_manager = manager.KernelManager(kernel_name=kernel_name)
+    # Have the supervisor publish the time taken by each launch phase
+    stats_dir = tempdir.TemporaryDirectory()
+    rik_kernel = 'remote_ikernel' in spec.argv
+    if rik_kernel:
+        kernel_manager.kernel_spec.argv = spec.argv + [
+            '--stats-format', 'json', '--stats-dir', stats_dir.name]
+
+    print("  * Starting {0}".format(spec.display_name))
+    start_time = time.time()
+    kernel_manager.start_kernel()
+    results['start'] = time.time() - start_time
+    client = kernel_manager.client()
+    client.start_channels()
+
+    try:
+        # Ready once the kernel answers through the tunnels
+        while True:
+            msg_id = client.kernel_info()
+            try:
+                _wait_for_reply(client, msg_id, 1)
+                break
+            except Empty:
+                if time.time() - start_time > timeout:
+                    raise RuntimeError("Kernel did not start in {0} "
+                                       "s".format(timeout))
+        results['ready'] = time.time() - start_time
+        print("  * Launch: process {0:.3f} s, ready {1:.3f} s".format(
+            results['start'], results['ready']))
+        if rik_kernel:
+            # Named after the connection file, known once started
+            stats_file = path.join(stats_dir.name, '{0}.stats.json'.format(
+                path.splitext(path.basename(
+                    kernel_manager.connection_file))[0]))
+            results['phases'] = _read_timings(stats_file,
+                                              BENCHMARK_STATS_TIMEOUT)
+            if results['phases']:
+                print("  * Launch phases: {0}".format(", ".join(
+                    "{0} {1:.3f} s".format(phase, results['phases'][phase])
+                    for phase in sorted(results['phases']))))
+            else:
+                print("  * Launch phases: not reported by the kernel")
+
+        # Empty code works with every language
+        latencies = []
+        for _ in range(requests):
+            request_time = time.time()
+            msg_id = client.execute('', store_history=False)
+            _wait_for_reply(client, msg_id, timeout)
+            latencies.append(time.time() - request_time)
+        if latencies:
+            results['execute'] = dict(
+                ('p{0}'.format(percent), _percentile(latencies, percent))
+                for percent in [50, 90, 99])
+            results['execute'].update(requests=requests, min=min(latencies),
+                                      max=max(latencies))
+            print("  * Execute round trip ({0} requests): min {1:.2f} ms, "
+                  "p50 {2:.2f} ms, p90 {3:.2f} ms, p99 {4:.2f} ms, "
+                  "max {5:.2f} ms".format(
+                      requests, *[1000 * results['execute'][key]
+                                  for key in ['min', 'p50', 'p90', 'p99',
+                                              'max']]))
+        else:
+            print("  * Execute round trip: skipped")
+
+        if spec.language == 'python':
+            request_time = time.time()
+            msg_id = client.execute("print('x' * {0})".format(
+                BENCHMARK_OUTPUT_SIZE), store_history=False)
+            output = _wait_for_idle(client, msg_id, timeout)
+            elapsed = time.time() - request_time
+            results['iopub'] = {'bytes': output, 'seconds': elapsed,
+                                'bytes_per_second': output / elapsed}
+            print("  * iopub throughput: {0:.2f} MB/s ({1:.1f} MB in "
+                  "{2:.2f} s)".format(output / elapsed / 1024 / 1024,
+                                      output / 1024.0 / 1024, elapsed))
+        else:
+            print("  * iopub throughput: skipped, only measured for Python "
+                  "kernels")
+    finally:
+        client.stop_channels()
+        shutdown_time = time.time()
+        kernel_manager.shutdown_kernel()
+        results['shutdown'] = time.time() - shutdown_time
+        stats_dir.cleanup()
+
+    if output_file is None:
+        output_file = 'rik_benchmark_{0}_{1}.json'.format(
+            kernel_name, time.strftime('%Y%m%d%H%M%S'))
+    with open(output_file, 'w') as results_file:
+        json.dump(results, results_file, sort_keys=True, indent=2)
+    print("  * Results saved in {0}".format(output_file))
+
+    return results
+
+
 def add_kernel(interface, name, kernel_cmd, cpus=1, pe=None, language=None,
                system=False, workdir=None, host=None, precmd=None,
-               launch_args=None, tunnel_hosts=None, verbose=False):
+               launch_args=None, tunnel_hosts=None, verbose=False,
+               telemetry_interval=None, mem_limit=None, daemon=False,
+               pack_cpus=None, remote_ports=None, stage=None,
+               stage_root=None, stage_writeback=False, record=None,
+               stats_format=None, stats_dir=None, idle_timeout=None,
+               spool_output=None):
     """
     Add a kernel. Generates a kernel.json and installs it for the system or
     user.
@@ -87,6 +283,10 @@ def add_kernel(interface, name, kernel_cmd, cpus=1, pe=None, language=None,
         argv.extend(['--interface', 'local'])
         kernel_name.append('local')
         display_name.append("Local")
+    elif interface == 'exec':
+        argv.extend(['--interface', 'exec'])
+        kernel_name.append('exec')
+        display_name.append("Local")
     elif interface == 'pbs':
         argv.extend(['--interface', 'pbs'])
         display_name.append('PBS')
@@ -141,6 +341,44 @@ def add_kernel(interface, name, kernel_cmd, cpus=1, pe=None, language=None,
     if verbose:
         argv.extend(['--verbose'])
 
+    if telemetry_interval:
+        argv.extend(['--telemetry-interval', '{0}'.format(telemetry_interval)])
+
+    if mem_limit:
+        argv.extend(['--mem-limit', '{0}'.format(mem_limit)])
+
+    if daemon:
+        argv.extend(['--daemon'])
+
+    if pack_cpus:
+        argv.extend(['--pack-cpus', '{0}'.format(pack_cpus)])
+
+    if remote_ports:
+        if remote_ports is True:
+            remote_ports = 'probe'
+        argv.extend(['--remote-ports', remote_ports])
+
+    if stage:
+        argv.extend(['--stage'] + stage)
+        if stage_root is not None:
+            argv.extend(['--stage-root', stage_root])
+        if stage_writeback:
+            argv.extend(['--stage-writeback'])
+
+    if record is not None:
+        argv.extend(['--record', record])
+
+    if stats_format is not None:
+        argv.extend(['--stats-format', stats_format])
+        if stats_dir is not None:
+            argv.extend(['--stats-dir', stats_dir])
+
+    if idle_timeout:
+        argv.extend(['--idle-timeout', '{0}'.format(idle_timeout)])
+
+    if spool_output:
+        argv.extend(['--spool-output', '{0}'.format(spool_output)])
+
     # protect the {connection_file} part of the kernel command
     kernel_cmd = kernel_cmd.replace('{connection_file}',
                                     '{host_connection_file}')
@@ -216,6 +454,15 @@ def manage():
                         "kernel according to other commandline options.")
     parser.add_argument('--delete', '-d', help="Remove the kernel and delete "
                         "the associated kernel.json.")
+    parser.add_argument('--benchmark', '-b', help="Start the kernel without a "
+                        "notebook and measure the launch time, execute round "
+                        "trip latency and iopub throughput.")
+    parser.add_argument('--benchmark-requests', type=int, default=100,
+                        help="Number of execute requests to time when "
+                        "benchmarking.")
+    parser.add_argument('--benchmark-output', help="File for the benchmark "
+                        "results, defaults to a timestamped json file in the "
+                        "current directory.")
     parser.add_argument('--kernel_cmd', '-k', help="Kernel command "
                         "to install.")
     parser.add_argument('--name', '-n', help="Name to identify the kernel,"
@@ -230,8 +477,12 @@ def manage():
                         "running through an SSH connection. For non standard "
                         "ports use host:port.")
     parser.add_argument('--interface', '-i',
-                        choices=['local', 'ssh', 'pbs', 'sge', 'slurm'],
-                        help="Specify how the remote kernel is launched.")
+                        choices=['local', 'exec', 'ssh', 'pbs', 'sge',
+                                 'slurm'],
+                        help="Specify how the remote kernel is launched. "
+                        "'exec' runs a local kernel directly, without a "
+                        "shell session, and keeps the notebook's connection "
+                        "file as is, so ipc transport also works.")
     parser.add_argument('--system', help="Install the kernel into the system "
                         "directory so that it is available for all users. "
                         "Might need admin privileges.", action='store_true')
@@ -252,6 +503,70 @@ def manage():
                         "interface. For non standard ports use host:port.")
     parser.add_argument('--verbose', '-v', action='store_true', help="Running "
                         "kernel will produce verbose debugging on the console.")
+    parser.add_argument('--telemetry-interval', type=int, help="Sample the "
+                        "CPU, memory, threads and open files of the remote "
+                        "kernel every this many seconds. The latest sample "
+                        "is written next to the connection file as "
+                        "'kernel-*.telemetry.json'.")
+    parser.add_argument('--mem-limit', type=int, help="Memory limit of the "
+                        "job in MB. A warning is logged when the kernel gets "
+                        "close to it. Requires --telemetry-interval.")
+    parser.add_argument('--daemon', action='store_true', help="Run the "
+                        "kernel through a shared supervisor daemon that "
+                        "handles launches, tunnels and health checks for all "
+                        "kernels in a single process. The daemon is started "
+                        "automatically when needed.")
+    parser.add_argument('--pack-cpus', type=int, help="Pack small kernels "
+                        "into shared batch jobs of this many cpus instead of "
+                        "submitting a job for each kernel. Each kernel is "
+                        "pinned to its own cpus on the job's node. Requires "
+                        "--daemon.")
+    parser.add_argument('--remote-ports', nargs='?', const='probe',
+                        choices=['probe', 'kernel'], help="Use free ports on "
+                        "the remote machine for the kernel and map the local "
+                        "ports onto them in the tunnels, to avoid collisions "
+                        "when many kernels run on one node. 'probe' (the "
+                        "default) picks ports before the kernel starts, so "
+                        "another process can still take one first; 'kernel' "
+                        "has the kernel bind any free ports and reads them "
+                        "back from its connection file, which needs a kernel "
+                        "that does this, like ipykernel. Needs python on the "
+                        "remote machine.")
+    parser.add_argument('--stage', nargs='+', help="Input files or "
+                        "directories, relative to the working directory, to "
+                        "sync into node-local scratch with rsync before "
+                        "starting the kernel there. Copies are reused by later "
+                        "kernels on the same node.")
+    parser.add_argument('--stage-root', help="Scratch location on the remote "
+                        "machine for staged inputs, default '$TMPDIR' or "
+                        "'/tmp'.")
+    parser.add_argument('--stage-writeback', action='store_true', help="Copy "
+                        "new and updated files from scratch back to the "
+                        "working directory when the kernel exits.")
+    parser.add_argument('--record', help="Save a timestamped transcript of "
+                        "the launch session output to this file (compressed "
+                        "if it ends in .gz). Play it back with the kernel "
+                        "option '--replay' to test launches offline.")
+    parser.add_argument('--stats-format', choices=['json', 'prom'],
+                        help="Publish runtime metrics for each kernel: tunnel "
+                        "restarts and outages, bytes through each channel and "
+                        "supervisor CPU and memory. 'prom' writes Prometheus "
+                        "text files for the node exporter textfile collector.")
+    parser.add_argument('--stats-dir', help="Directory for the metrics "
+                        "files, 'kernel-*.stats.json' or 'kernel-*.stats.prom'. "
+                        "Defaults to the location of the connection file.")
+    parser.add_argument('--idle-timeout', type=int, help="Release the job "
+                        "or session of a remote kernel after this many seconds "
+                        "without requests or output. The kernel is relaunched "
+                        "when the next request arrives, but its state is "
+                        "lost. Needs 'ss' and pyzmq locally.")
+    parser.add_argument('--spool-output', type=int, help="Keep the output "
+                        "of the kernel process in rotating files of up to "
+                        "this many MB in the working directory on the remote "
+                        "machine, older output compressed, instead of sending "
+                        "it back over the session. The end of it is logged if "
+                        "the kernel dies, or when the remote_ikernel process "
+                        "receives SIGUSR1.")
 
     # Temporarily remove 'manage' from the arguments
     raw_args = sys.argv[:]
@@ -264,7 +579,13 @@ def manage():
                                  args.cpus, args.pe, args.language, args.system,
                                  args.workdir, args.host, args.remote_precmd,
                                  args.remote_launch_args, args.tunnel_hosts,
-                                 args.verbose)
+                                 args.verbose, args.telemetry_interval,
+                                 args.mem_limit, args.daemon, args.pack_cpus,
+                                 args.remote_ports, args.stage,
+                                 args.stage_root, args.stage_writeback,
+                                 args.record, args.stats_format,
+                                 args.stats_dir, args.idle_timeout,
+                                 args.spool_output)
         print("Installed kernel {0}.".format(kernel_name))
     elif args.delete:
         if args.delete in existing_kernels:
@@ -278,5 +599,14 @@ def manage():
         else:
             print("Kernel {0} doesn't exist".format(args.show))
             print("\n".join(description[2:]))
+    elif args.benchmark:
+        if args.benchmark_requests < 0:
+            parser.error("--benchmark-requests cannot be negative")
+        if args.benchmark in existing_kernels:
+            benchmark_kernel(args.benchmark, args.benchmark_requests,
+                             args.benchmark_output)
+        else:
+            print("Kernel {0} doesn't exist".format(args.benchmark))
+            print("\n".join(description[2:]))
     else:
         parser.print_help()
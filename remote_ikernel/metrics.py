@@ -0,0 +1,139 @@
+"""
+metrics.py
+
+Runtime measurements of a remote kernel's supervisor and tunnels, and
+formatting them for monitoring systems.
+
+"""
+
+import os
+import re
+import resource
+import subprocess
+
+# Address line of a socket from 'ss', the local address is first
+SS_ADDRESS_RE = re.compile(r'\S+:(\d+)\s+\S+:\S+\s*$')
+SS_RECEIVED_RE = re.compile(r'bytes_received:(\d+)')
+SS_ACKED_RE = re.compile(r'bytes_acked:(\d+)')
+
+
+def channel_bytes(ports):
+    """
+    Count the bytes that have passed through the connections accepted on
+    the given local ports. Only open connections are counted, as reported
+    by 'ss' from iproute2.
+
+    Parameters
+    ----------
+    ports : dict
+        Channel name -> local port number.
+
+    Returns
+    -------
+    channels : dict
+        Channel name -> {'received': bytes from the notebook,
+        'sent': bytes to the notebook}. Empty if 'ss' is not available.
+    """
+    port_filter = " or ".join(["sport = :{0}".format(port)
+                               for port in ports.values()])
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(
+                ['ss', '-tin', 'state', 'established',
+                 '( {0} )'.format(port_filter)], stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+
+    by_port = dict((port, name) for name, port in ports.items())
+    channels = dict((name, {'received': 0, 'sent': 0}) for name in ports)
+    channel = None
+    for line in output.decode('utf-8', 'replace').splitlines():
+        if not line[:1].isspace():
+            # New socket, or the header
+            match = SS_ADDRESS_RE.search(line)
+            channel = by_port.get(int(match.group(1))) if match else None
+        elif channel is not None:
+            received = SS_RECEIVED_RE.search(line)
+            acked = SS_ACKED_RE.search(line)
+            if received:
+                channels[channel]['received'] += int(received.group(1))
+            if acked:
+                channels[channel]['sent'] += int(acked.group(1))
+    return channels
+
+
+def supervisor_usage():
+    """
+    CPU time and memory used by this process.
+
+    Returns
+    -------
+    usage : dict
+        'cpu_seconds' (user + system) and 'rss_mb'.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # Current RSS from /proc, otherwise the peak (kB on Linux)
+    rss_kb = usage.ru_maxrss
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    rss_kb = int(line.split()[1])
+    except IOError:
+        pass
+    return {'cpu_seconds': usage.ru_utime + usage.ru_stime,
+            'rss_mb': rss_kb / 1024.0}
+
+
+def format_prometheus(stats):
+    """
+    Format kernel stats as Prometheus text exposition, for use with the
+    node exporter textfile collector.
+
+    Parameters
+    ----------
+    stats : dict
+        Stats as written by RemoteIKernel.write_stats.
+
+    Returns
+    -------
+    text : str
+        The metrics, one per line.
+    """
+    labels = 'kernel="{0}",host="{1}"'.format(stats['kernel'],
+                                              stats['host'] or '')
+    lines = []
+
+    def _metric(name, metric_type, value, extra_labels=''):
+        """Add a sample, with the type declared the first time."""
+        type_line = '# TYPE {0} {1}'.format(name, metric_type)
+        if type_line not in lines:
+            lines.append(type_line)
+        lines.append('{0}{{{1}{2}}} {3}'.format(name, labels, extra_labels,
+                                                value))
+
+    _metric('rik_uptime_seconds', 'gauge', stats['uptime'])
+    _metric('rik_tunnel_restarts_total', 'counter', stats['tunnel_restarts'])
+    _metric('rik_tunnel_outage_seconds_total', 'counter',
+            stats['tunnel_outage_seconds_total'])
+    _metric('rik_tunnel_last_outage_seconds', 'gauge',
+            stats['tunnel_last_outage_seconds'])
+    # Samples for each metric have to be kept together
+    for direction in ['received', 'sent']:
+        for channel, counts in sorted(stats['channel_bytes'].items()):
+            _metric('rik_channel_{0}_bytes'.format(direction), 'gauge',
+                    counts[direction], ',channel="{0}"'.format(channel))
+    _metric('rik_released', 'gauge', int(stats['released']))
+    _metric('rik_idle_releases_total', 'counter', stats['idle_releases'])
+    if stats['last_resume_seconds'] is not None:
+        _metric('rik_last_resume_seconds', 'gauge',
+                stats['last_resume_seconds'])
+    _metric('rik_interrupts_total', 'counter', stats['interrupts'])
+    if stats['last_interrupt_seconds'] is not None:
+        _metric('rik_last_interrupt_seconds', 'gauge',
+                stats['last_interrupt_seconds'])
+    _metric('rik_supervisor_cpu_seconds_total', 'counter',
+            stats['supervisor']['cpu_seconds'])
+    _metric('rik_supervisor_rss_bytes', 'gauge',
+            int(stats['supervisor']['rss_mb'] * 1024 * 1024))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,290 @@
+"""
+packing.py
+
+Pack several small kernels into a single scheduler allocation. The
+allocation is an interactive job with no kernel of its own; packed
+kernels reach its node over ssh and join the job through the scheduler
+(``srun --overlap``, ``qrsh -inherit`` or ``pbs_tmrsh``), so they are
+accounted to it, limited by it and end with it. If the job is bound to
+its own cpus each kernel is pinned to a slice of them. The ssh sessions
+and tunnels share one master connection.
+
+Packing is done by the supervisor daemon, see ``daemon.py``.
+
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+
+import pexpect
+
+from remote_ikernel.daemon import runtime_dir
+from remote_ikernel.kernel import RemoteIKernel, _shell_quote
+
+# Only batch queues have allocations worth sharing
+PACK_INTERFACES = ['pbs', 'sge', 'slurm']
+# Digits required, so the echoed command is not matched
+CPU_LIST_RE = r'rik_cpus ([\d,-]+)'
+# Job environment that a process on the node needs to join the job
+JOB_VARIABLES = {
+    'pbs': ['PBS_JOBID', 'PBS_JOBCOOKIE', 'PBS_MOMPORT', 'PBS_NODENUM',
+            'PBS_TASKNUM', 'PBS_VNODENUM', 'PBS_NODEFILE'],
+    'sge': ['JOB_ID', 'SGE_TASK_ID', 'SGE_ROOT', 'SGE_CELL', 'PE_HOSTFILE',
+            'TMPDIR'],
+    'slurm': ['SLURM_JOB_ID']}
+# The quotes split the marker in the echoed command, so only the output
+# is matched
+JOB_ENV_CMD = "echo rik_job''_env {0}"
+JOB_ENV_RE = r'rik_job_env([^\r\n]*)\r?\n'
+# Start a shell inside the job, the job environment is set for these
+JOIN_COMMANDS = {
+    'pbs': 'pbs_tmrsh {host} /bin/bash -i',
+    'sge': 'qrsh -inherit {host} /bin/bash -i',
+    'slurm': ('srun --jobid {SLURM_JOB_ID} --overlap -w {host} -N 1 -n 1 '
+              '-c {cpus} -u /bin/bash -i')}
+# How long to wait for the ssh master to come up
+MASTER_TIMEOUT = 10
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Expand a Linux cpu list, as found in /proc/self/status.
+
+    Parameters
+    ----------
+    cpu_list : str
+        Ranges of cpus, e.g. '0-3,8,10-11'.
+
+    Returns
+    -------
+    cpu_ids : list of int
+        The individual cpu ids.
+    """
+    cpu_ids = []
+    for part in cpu_list.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpu_ids.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpu_ids.append(int(part))
+    return cpu_ids
+
+
+class Allocation(RemoteIKernel):
+    """
+    A scheduler job that holds cpus for several kernels. The session is
+    launched through the usual interface, but is only kept open to hold
+    the job; the kernels are started separately.
+
+    """
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, interface, cpus, pe='smp', launch_args=None,
+                 tunnel_hosts=None, env=None):
+        """
+        Describe the allocation. Nothing is launched until start is called.
+        """
+        self.log = logging.getLogger('remote_ikernel')
+        self.interface = interface
+        self.cpus = cpus
+        self.pe = pe
+        self.launch_args = launch_args
+        self.tunnel_hosts = tunnel_hosts
+        # From the kernel that started it; later ones share the job
+        self.env = env
+        self.host = None
+        self.connection = None
+        self.record = None
+        self.replay = None
+        self.master = None  # ssh master connection for the tunnels
+        self.control_path = None
+        self.job_env = {}  # What packed kernels need to join the job
+        self.pinned = False  # Whether the kernels get their own cpus
+        self.free_cpus = []
+        self.reserved = 0  # cpus promised to kernels, managed by the daemon
+        self.ready = threading.Event()
+        self.error = None
+        self.lock = threading.Lock()
+
+    @property
+    def key(self):
+        """Allocations with the same key can host the same kernels."""
+        return (self.interface, self.cpus, self.pe, self.launch_args,
+                tuple(self.tunnel_hosts or []))
+
+    @property
+    def available(self):
+        """Number of cpus that are not promised to a kernel."""
+        return self.cpus - self.reserved
+
+    def start(self):
+        """
+        Launch the job and find out which cpus it has. Sets ready when
+        finished, with error set if it failed.
+        """
+        try:
+            self.launch()
+            if hasattr(self.host, 'decode'):
+                self.host = self.host.decode('utf-8')
+            self.job_env = self.find_job()
+            self.free_cpus = self.find_cpus()
+            if not self.tunnel_hosts:
+                self.start_master()
+            self.log.info("Allocation of {0} cpus on {1} ready for "
+                          "packing.".format(self.cpus, self.host))
+        except Exception as error:  # pylint: disable=broad-except
+            self.error = error
+            self.shutdown()
+        finally:
+            self.ready.set()
+
+    def find_job(self):
+        """
+        Read the variables that identify the job from its shell, so that
+        packed kernels can be started inside it.
+
+        Returns
+        -------
+        job_env : dict
+            Values of the JOB_VARIABLES that are set in the job.
+        """
+        self.connection.sendline(JOB_ENV_CMD.format(" ".join(
+            '{0}="${0}"'.format(variable)
+            for variable in JOB_VARIABLES[self.interface])))
+        try:
+            self.connection.expect(JOB_ENV_RE, timeout=30)
+        except pexpect.TIMEOUT:
+            raise RuntimeError("Unable to identify the job on {0}; kernels "
+                               "cannot be packed into it.".format(self.host))
+        fields = self.connection.match.groups()[0]
+        if hasattr(fields, 'decode'):
+            fields = fields.decode('utf-8')
+        job_env = dict(field.split('=', 1) for field in fields.split()
+                       if '=' in field and not field.endswith('='))
+        # The first variable is the job id
+        if JOB_VARIABLES[self.interface][0] not in job_env:
+            raise RuntimeError("No job found in the session on {0}; kernels "
+                               "cannot be packed into it.".format(self.host))
+        self.log.debug("Job environment: {0}.".format(job_env))
+        return job_env
+
+    def find_cpus(self):
+        """
+        Ask the job which cpus it may use. Kernels are only pinned if
+        these are exactly the cpus of the job; a job that is not bound to
+        its own cpus may use any of the node's, and picking some of them
+        could put kernels on the cpus of other jobs.
+        """
+        self.connection.sendline("echo rik_cpus $(awk "
+                                 "'/^Cpus_allowed_list/{print $2}' "
+                                 "/proc/self/status)")
+        try:
+            self.connection.expect(CPU_LIST_RE, timeout=30)
+            cpu_list = self.connection.match.groups()[0]
+            if hasattr(cpu_list, 'decode'):
+                cpu_list = cpu_list.decode('utf-8')
+            cpu_ids = parse_cpu_list(cpu_list)
+        except pexpect.TIMEOUT:
+            cpu_ids = []
+        self.pinned = len(cpu_ids) == self.cpus
+        if not self.pinned:
+            self.log.warning("Job is not bound to {0} cpus (found {1}); "
+                             "packed kernels will not be pinned.".format(
+                                 self.cpus, len(cpu_ids)))
+            # Only counts the kernels in, the scheduler limits the job
+            cpu_ids = [None] * self.cpus
+        return cpu_ids
+
+    def start_master(self):
+        """
+        Start an ssh master connection to the node for the packed kernels
+        to multiplex their sessions and tunnels through.
+        """
+        control_path = os.path.join(
+            runtime_dir(), 'rik_{0}.ctl'.format(uuid.uuid4().hex[:8]))
+        self.master = pexpect.spawn(
+            'ssh -o StrictHostKeyChecking=no -o ControlMaster=yes -S {0} -N '
+            '{1}'.format(control_path, self.host), env=self.env)
+        deadline = time.time() + MASTER_TIMEOUT
+        while time.time() < deadline and self.master.isalive():
+            if os.path.exists(control_path):
+                self.control_path = control_path
+                return
+            time.sleep(0.1)
+        self.log.warning("No ssh master on {0}; packed kernels will use their "
+                         "own connections.".format(self.host))
+
+    def is_alive(self):
+        """Check that the job is still running."""
+        return self.connection is not None and self.connection.isalive()
+
+    @property
+    def join_cmd(self):
+        """
+        Command that replaces an ssh session on the node with a shell
+        inside the job, or None before the job is known.
+        """
+        if not self.job_env:
+            return None
+        variables = " ".join("{0}={1}".format(name, _shell_quote(value))
+                             for name, value in sorted(self.job_env.items()))
+        join = JOIN_COMMANDS[self.interface].format(
+            host=self.host, cpus=self.cpus, **self.job_env)
+        return 'exec env {0} {1}'.format(variables, join)
+
+    def pack(self, kernel_args):
+        """
+        Take cpus for a kernel and turn its arguments into ones that will
+        start it inside the allocation's job.
+
+        Parameters
+        ----------
+        kernel_args : dict
+            Keyword arguments for RemoteIKernel, as given by the client.
+
+        Returns
+        -------
+        packed_args : dict
+            Keyword arguments that start the kernel in this allocation.
+        cpu_ids : list of int
+            The cpus given to the kernel, to be returned with unpack.
+        """
+        with self.lock:
+            cpu_ids = self.free_cpus[:kernel_args['cpus']]
+            self.free_cpus = self.free_cpus[kernel_args['cpus']:]
+
+        packed_args = dict(kernel_args)
+        # Many kernels on one node, so let the node pick the ports
+        packed_args.update(
+            interface='ssh', host=self.host, launch_args=None,
+            control_path=self.control_path,
+            remote_ports=kernel_args['remote_ports'] or 'probe',
+            join_cmd=self.join_cmd)
+        if self.pinned:
+            cpu_string = ",".join("{0}".format(cpu_id) for cpu_id in cpu_ids)
+            self.log.info("Packing kernel into {0} on cpus {1}.".format(
+                self.host, cpu_string))
+            packed_args['kernel_cmd'] = 'taskset -c {0} {1}'.format(
+                cpu_string, kernel_args['kernel_cmd'])
+        else:
+            self.log.info("Packing kernel into {0}.".format(self.host))
+        return packed_args, cpu_ids
+
+    def unpack(self, cpu_ids):
+        """
+        Give back the cpus of a kernel that has finished.
+        """
+        with self.lock:
+            self.free_cpus.extend(cpu_ids)
+
+    def shutdown(self):
+        """
+        End the ssh master and the job.
+        """
+        if self.master is not None and self.master.isalive():
+            self.master.terminate(force=True)
+        if self.connection is not None and self.connection.isalive():
+            self.connection.terminate(force=True)
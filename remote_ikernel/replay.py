@@ -0,0 +1,162 @@
+"""
+replay.py
+
+Record the output of a launch session and play it back later. A
+transcript is a file of json lines, ``[seconds, text]``, holding each
+chunk of output from the session and when it arrived. Files ending in
+``.gz`` are compressed. Recordings are flushed every second, so if the
+recording process is killed only the last moments are lost, and an
+incomplete last record is ignored when reading.
+
+Record with the ``--record`` kernel option. Running this module plays a
+transcript on stdout, which is how ``--replay`` feeds it back to
+RemoteIKernel:
+
+    python -m remote_ikernel.replay [--speed 10] transcript.jsonl.gz
+
+"""
+
+import argparse
+import gzip
+import json
+import os
+import select
+import sys
+import termios
+import time
+import zlib
+
+# Seconds between flushes of the recording
+FLUSH_INTERVAL = 1
+
+
+def _open(filename, mode):
+    """Open a transcript, compressed if the name ends in .gz."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 'b')
+    return open(filename, mode + 'b')
+
+
+class Transcript(object):
+    """
+    File-like object to attach to a pexpect spawn as logfile_read that
+    writes everything it is given, with timestamps, to a transcript.
+
+    """
+
+    def __init__(self, filename):
+        self.file = _open(filename, 'w')
+        self.start = time.time()
+        self._flushed = self.start
+
+    def write(self, data):
+        """Record a chunk of output."""
+        # latin-1 maps all bytes to text and back unchanged
+        if hasattr(data, 'decode'):
+            data = data.decode('latin-1')
+        now = time.time()
+        line = json.dumps([round(now - self.start, 4), data])
+        self.file.write((line + '\n').encode('utf-8'))
+        # Compressed data only becomes readable once flushed
+        if now - self._flushed > FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Make the recording so far readable."""
+        self.file.flush()
+        self._flushed = time.time()
+
+    def close(self):
+        """Finish the transcript."""
+        self.file.close()
+
+
+def read_transcript(filename):
+    """
+    Load a transcript. A recording that was cut off is read up to the
+    last complete record.
+
+    Parameters
+    ----------
+    filename : str
+        Location of the transcript.
+
+    Returns
+    -------
+    chunks : list of (float, bytes)
+        Time, in seconds since the start, and output for each chunk.
+    """
+    chunks = []
+    with _open(filename, 'r') as transcript:
+        try:
+            for line in transcript:
+                if line.strip():
+                    stamp, data = json.loads(line.decode('utf-8'))
+                    chunks.append((stamp, data.encode('latin-1')))
+        except (EOFError, IOError, ValueError, zlib.error):
+            # Missing end of stream or a partly written record
+            pass
+    return chunks
+
+
+def _drain(stream, timeout):
+    """
+    Wait for up to timeout seconds, discarding anything sent to us in
+    the meantime so the sender never blocks.
+    """
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        readable = select.select([stream], [], [], remaining)[0]
+        if readable and not os.read(stream.fileno(), 4096):
+            # Input closed, just wait
+            time.sleep(max(0, deadline - time.time()))
+            return
+
+
+def replay(filename, speed=1.0):
+    """
+    Write a transcript to stdout with the recorded timing.
+
+    Parameters
+    ----------
+    filename : str
+        Location of the transcript.
+    speed : float
+        Factor to speed up the playback by. Zero plays it all at once.
+    """
+    # Commands sent to a real session are echoed in the recording
+    # already, so don't echo them a second time.
+    if sys.stdin.isatty():
+        attributes = termios.tcgetattr(sys.stdin)
+        attributes[3] &= ~termios.ECHO
+        termios.tcsetattr(sys.stdin, termios.TCSANOW, attributes)
+
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    previous = 0.0
+    for stamp, data in read_transcript(filename):
+        if speed > 0:
+            _drain(sys.stdin, (stamp - previous) / speed)
+        previous = stamp
+        out.write(data)
+        out.flush()
+
+
+def main():
+    """
+    Read command line arguments and replay a transcript.
+    """
+    parser = argparse.ArgumentParser(
+        description="Play back a recorded remote_ikernel launch session.")
+    parser.add_argument('transcript')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Factor to speed up the playback by, 0 for no "
+                        "delays.")
+    args = parser.parse_args()
+    replay(args.transcript, args.speed)
+
+
+if __name__ == '__main__':
+    main()